@@ -0,0 +1,151 @@
+"""
+Benchmark for the statistics page aggregates.
+
+Seeds a temporary SQLite database with one synthetic power user and compares
+the old per-checklist query loop with user_stats.user_statistics.
+
+    python benchmarks/bench_statistics.py --checklists 5000 --species 20
+"""
+
+import argparse
+import datetime
+import importlib.util
+import os
+import random
+import tempfile
+import time
+
+from pydal import DAL, Field
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+spec = importlib.util.spec_from_file_location(
+    "user_stats", os.path.join(APP_FOLDER, "user_stats.py")
+)
+user_stats = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(user_stats)
+
+
+def define_tables(db):
+    db.define_table("species", Field("name", unique=True))
+    db.define_table(
+        "sighting",
+        Field("event_id"),
+        Field("species_id", "reference species"),
+        Field("count", "integer"),
+    )
+    db.define_table(
+        "checklist",
+        Field("event_id"),
+        Field("latitude", "double"),
+        Field("longitude", "double"),
+        Field("date", "datetime"),
+        Field("observer_id"),
+        Field("duration_minutes", "integer"),
+    )
+    db.executesql("CREATE INDEX sighting_event_id ON sighting (event_id);")
+    db.executesql(
+        "CREATE INDEX checklist_observer_date ON checklist (observer_id, date);"
+    )
+
+
+def seed(db, checklists, species, others):
+    ids = [db.species.insert(name="Species %d" % i) for i in range(400)]
+    start = datetime.datetime(2021, 1, 1, 7)
+    sightings = []
+    for i in range(checklists + others):
+        event_id = str(i)
+        db.checklist.insert(
+            event_id=event_id,
+            latitude=random.uniform(30, 45),
+            longitude=random.uniform(-120, -75),
+            date=start + datetime.timedelta(hours=random.randrange(24 * 365)),
+            observer_id="1" if i < checklists else str(2 + i % 500),
+            duration_minutes=random.randrange(5, 240),
+        )
+        for species_id in random.sample(ids, species):
+            sightings.append((event_id, species_id, random.randrange(1, 20)))
+    db._adapter.cursor.executemany(
+        "INSERT INTO sighting (event_id, species_id, count) VALUES (?, ?, ?);",
+        sightings,
+    )
+    db.commit()
+
+
+# The statistics() loop this benchmark replaced: one query per checklist
+def legacy_statistics(db, observer_id, search=""):
+    events = (
+        db(db.checklist.observer_id == observer_id)
+        .select()
+        .sort(lambda row: row.date)
+        .as_list()
+    )
+    sightingsByDay = {}
+    for event in events:
+        date = event["date"].date()
+        sightingsByDay[date] = sightingsByDay.get(date, 0) + 1
+    speciesSeen = {}
+    for event in events:
+        query = (db.sighting.event_id == event["event_id"]) & (
+            db.sighting.species_id == db.species.id
+        )
+        if search:
+            query &= db.species.name.contains(search)
+        species = db(query).select(db.species.name).first()
+        if species is None:
+            continue
+        speciesSeen.setdefault(species.name, []).append(
+            (event["date"].date(), (event["latitude"], event["longitude"]))
+        )
+    timeByDay = {}
+    for event in events:
+        date = event["date"].date()
+        timeByDay[date] = timeByDay.get(date, 0) + event["duration_minutes"]
+    timeByMonth = {}
+    for event in events:
+        month = event["date"].date().month
+        timeByMonth[month] = timeByMonth.get(month, 0) + event["duration_minutes"]
+    return sightingsByDay
+
+
+def measure(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--checklists", type=int, default=5000)
+    parser.add_argument("--species", type=int, default=20)
+    parser.add_argument("--others", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    folder = tempfile.mkdtemp()
+    db = DAL("sqlite://bench.db", folder=folder)
+    define_tables(db)
+    seed(db, args.checklists, args.species, args.others)
+    print(
+        "user with %d checklists, %d sightings in total"
+        % (args.checklists, db(db.sighting).count())
+    )
+
+    for search in ("", "Species 1"):
+        legacy = measure(lambda: legacy_statistics(db, "1", search), args.repeat)
+        current = measure(
+            lambda: user_stats.user_statistics(db, "1", search), args.repeat
+        )
+        print(
+            "search=%-12r legacy %.3fs  user_statistics %.3fs  speedup %.1fx"
+            % (search, legacy, current, legacy / current)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+Index advisor for the queries of the app's actions.
+
+Replays the SELECT statements captured in a query log (QUERY_LOG in
+settings.py) against the app's SQLite database with EXPLAIN QUERY PLAN, and
+flags full table scans and temporary B-trees built for GROUP BY, ORDER BY or
+DISTINCT. For each flagged query it derives candidate indexes from the
+columns the query compares and groups on, creates each candidate inside a
+transaction that is rolled back, and reports the new plan and timing, so that
+an index is only added to models.INDEXES for a measured improvement.
+
+    # in settings.py: QUERY_LOG = "/tmp/queries.jsonl", then use the app
+    python benchmarks/index_advisor.py /tmp/queries.jsonl
+    python benchmarks/index_advisor.py /tmp/queries.jsonl --action api/sightings
+
+Statements are grouped by shape, with their literals replaced, and the
+slowest example of each shape is explained and timed.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import re
+import time
+
+from pydal import DAL
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?(?:e[-+]?\d+)?\b")
+LISTS = re.compile(r"\(\?(?:, \?)+\)")
+SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(.*)$")
+TEMP_BTREE = re.compile(r"USE TEMP B-TREE FOR (.*)")
+GROUP_BY = re.compile(r"\bGROUP BY (.*?)(?:\bHAVING\b|\bORDER BY\b|\bLIMIT\b|;|$)")
+
+
+# Loads the app settings without importing the app itself
+def load_settings():
+    spec = importlib.util.spec_from_file_location(
+        "settings", os.path.join(APP_FOLDER, "settings.py")
+    )
+    settings = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(settings)
+    return settings
+
+
+# The statement with its literals replaced, so that repeats group together
+def shape(sql):
+    return LISTS.sub("(?...)", LITERALS.sub("?", sql))
+
+
+# Captured statements grouped by shape: shape -> dict of the actions, the
+# number of runs, their total time and the slowest statement
+def read_log(paths, action=None):
+    shapes = {}
+    for path in paths:
+        with open(path) as log:
+            for line in log:
+                entry = json.loads(line)
+                if action and entry["action"] != action:
+                    continue
+                group = shapes.setdefault(
+                    shape(entry["sql"]),
+                    dict(actions=set(), runs=0, seconds=0.0, slowest=(0.0, None)),
+                )
+                group["actions"].add(entry["action"])
+                group["runs"] += 1
+                group["seconds"] += entry["seconds"]
+                group["slowest"] = max(group["slowest"], (entry["seconds"], entry["sql"]))
+    return shapes
+
+
+# Columns of every table that can be indexed: table -> set of column names
+def table_columns(db):
+    rows = db.executesql("SELECT name, sql FROM sqlite_master WHERE type = 'table';")
+    virtual = [name for name, sql in rows if sql.upper().startswith("CREATE VIRTUAL")]
+    # Virtual tables and their shadow tables, like the R*Tree's _node
+    tables = [
+        name
+        for name, _ in rows
+        if not any(name == v or name.startswith(v + "_") for v in virtual)
+    ]
+    return {
+        table: {row[1] for row in db.executesql('PRAGMA table_info("%s");' % table)}
+        for table in tables
+    }
+
+
+# Existing indexes: table -> list of column lists
+def table_indexes(db):
+    indexes = {}
+    for name, table in db.executesql(
+        "SELECT name, tbl_name FROM sqlite_master WHERE type = 'index';"
+    ):
+        columns = [row[2] for row in db.executesql('PRAGMA index_info("%s");' % name)]
+        indexes.setdefault(table, []).append(columns)
+    return indexes
+
+
+def explain(db, sql):
+    return [row[3] for row in db.executesql("EXPLAIN QUERY PLAN " + sql)]
+
+
+# Problems in a plan, as (kind, table or None, detail)
+def problems(plan, tables):
+    found = []
+    for detail in plan:
+        scan = SCAN.match(detail)
+        if scan and scan.group(1) in tables and "USING" not in scan.group(2):
+            found.append(("full scan", scan.group(1), detail))
+        temp = TEMP_BTREE.search(detail)
+        if temp:
+            found.append(("temp b-tree", None, detail))
+    return found
+
+
+# Seconds of the fastest of a few runs of the statement
+def timing(db, sql, runs=5):
+    best = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        db.executesql(sql)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Columns of table compared in the statement, split into equality and range
+# comparisons, and the ones it groups on
+def referenced_columns(sql, table, columns):
+    reference = r'"?%s"?\."?(\w+)"?' % re.escape(table)
+    equal, ranges = [], []
+    for column, operator in re.findall(
+        reference + r"\s*(=|IN\b|>=|<=|>|<|BETWEEN\b)", sql, re.IGNORECASE
+    ):
+        # id is the rowid, which needs no index
+        if column not in columns or column == "id":
+            continue
+        target = equal if operator.upper() in ("=", "IN") else ranges
+        if column not in target:
+            target.append(column)
+    grouped = []
+    group_by = GROUP_BY.search(sql)
+    if group_by:
+        for column in re.findall(reference, group_by.group(1)):
+            if column in columns and column != "id" and column not in grouped:
+                grouped.append(column)
+    return equal, [c for c in ranges if c not in equal], grouped
+
+
+# Candidate indexes, as (table, columns), for the problems of a statement
+def candidates(sql, found, tables, indexes):
+    suggested = []
+    scanned = [table for kind, table, _ in found if kind == "full scan"]
+    if any(kind == "temp b-tree" for kind, _, _ in found):
+        # The B-tree sorts rows of the tables read, whichever they are
+        scanned += [t for t in tables if re.search(r'\b"?%s"?\.' % t, sql)]
+    for table in dict.fromkeys(scanned):
+        equal, ranges, grouped = referenced_columns(sql, table, tables[table])
+        options = [equal + ranges[:1], equal + [c for c in grouped if c not in equal]]
+        for columns in options:
+            existing = indexes.get(table, [])
+            if columns and columns not in [c[: len(columns)] for c in existing]:
+                if (table, columns) not in suggested:
+                    suggested.append((table, columns))
+    return suggested
+
+
+# Plan and time of the statement with the index, which is then dropped
+def try_index(db, sql, table, columns):
+    db.executesql("BEGIN;")
+    try:
+        db.executesql(
+            'CREATE INDEX advisor_candidate ON "%s" (%s);' % (table, ", ".join(columns))
+        )
+        return explain(db, sql), timing(db, sql)
+    finally:
+        db.rollback()
+
+
+def main():
+    settings = load_settings()
+    parser = argparse.ArgumentParser(
+        description="Suggest indexes for the queries captured in a query log."
+    )
+    parser.add_argument("logs", nargs="+", help="query logs written by the app")
+    parser.add_argument("--uri", default=settings.DB_URI)
+    parser.add_argument("--folder", default=settings.DB_FOLDER)
+    parser.add_argument("--action", help="only the queries of this action")
+    parser.add_argument(
+        "--all", action="store_true", help="also list the queries without problems"
+    )
+    args = parser.parse_args()
+
+    db = DAL(args.uri, folder=args.folder, migrate_enabled=False)
+    if db._adapter.dbengine != "sqlite":
+        parser.error("EXPLAIN QUERY PLAN needs a SQLite database")
+    tables = table_columns(db)
+    indexes = table_indexes(db)
+
+    helpful = []  # (table, columns, action, before, after)
+    shapes = read_log(args.logs, args.action)
+    print("%d statements of %d shapes" % (sum(g["runs"] for g in shapes.values()), len(shapes)))
+    for group in sorted(shapes.values(), key=lambda g: -g["seconds"]):
+        sql = group["slowest"][1]
+        try:
+            plan = explain(db, sql)
+        except Exception as error:
+            # Tables created by py4web or dropped since the capture
+            db.rollback()
+            print("\n(skipped: %s)" % error)
+            continue
+        found = problems(plan, tables)
+        if not found and not args.all:
+            continue
+        print(
+            "\n%s: %d runs, %.3fs total, %.1fms slowest"
+            % (
+                ", ".join(sorted(group["actions"])),
+                group["runs"],
+                group["seconds"],
+                group["slowest"][0] * 1000,
+            )
+        )
+        print("  " + sql[:300] + ("..." if len(sql) > 300 else ""))
+        for detail in plan:
+            print("    plan: " + detail)
+        if not found:
+            continue
+        before = timing(db, sql)
+        for table, columns in candidates(sql, found, tables, indexes):
+            after_plan, after = try_index(db, sql, table, columns)
+            remaining = problems(after_plan, tables)
+            # A clear speedup, rather than timing noise, or fewer problems
+            # at no cost
+            helps = after < 0.8 * before or (
+                len(remaining) < len(found) and after <= before
+            )
+            print(
+                "  index %s (%s): %.1fms -> %.1fms, %d -> %d problems%s"
+                % (
+                    table,
+                    ", ".join(columns),
+                    before * 1000,
+                    after * 1000,
+                    len(found),
+                    len(remaining),
+                    "" if helps else ", no gain",
+                )
+            )
+            if helps:
+                for detail in after_plan:
+                    print("    plan: " + detail)
+                helpful.append((table, columns, sorted(group["actions"]), before, after))
+    db.close()
+
+    print("\nSuggested indexes:" if helpful else "\nNo index to suggest.")
+    for table, columns, actions, before, after in helpful:
+        print(
+            "  %s (%s) for %s: %.1fms -> %.1fms"
+            % (table, ", ".join(columns), ", ".join(actions), before * 1000, after * 1000)
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""
+Load test for the app's HTTP endpoints.
+
+Builds a throwaway copy of the app whose database is seeded by scaling up the
+sample checklists and sightings, starts it with py4web, then replays requests
+against every endpoint: first each endpoint alone, then a weighted mix. For each
+phase it reports p50/p95/p99 latency, throughput and the server's peak RSS, as
+JSON so that runs can be compared.
+
+    python benchmarks/load_test.py run --sightings 1000000 --output before.json
+    python benchmarks/load_test.py run --workdir /tmp/bench --output after.json
+    python benchmarks/load_test.py compare before.json after.json
+
+The seeded database is kept in --workdir and reused by later runs with the same
+--sightings, since seeding 10M sightings takes a few minutes.
+"""
+
+import argparse
+import datetime
+import http.cookiejar
+import importlib.util
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from pydal import DAL
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_NAME = os.path.basename(APP_FOLDER)
+SAMPLE_FOLDER = os.path.join(APP_FOLDER, "sample_data")
+
+spec = importlib.util.spec_from_file_location(
+    "dbpopulator", os.path.join(SAMPLE_FOLDER, "dbpopulator.py")
+)
+dbpopulator = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dbpopulator)
+
+EMAIL = "loadtest@example.com"
+PASSWORD = "Load-test-1234"
+
+# Share of each endpoint in the mixed phase
+MIX = {
+    "api/sightings/tiles": 35,
+    "api/sightings": 15,
+    "api/species_by_region": 10,
+    "api/species_trends": 10,
+    "api/top_contributors": 10,
+    "api/get_checklists": 8,
+    "statistics": 7,
+    "checklist/submit": 5,
+}
+
+
+# A copy of the app made of symlinks, with its own databases folder
+def make_app(workdir):
+    apps = os.path.join(workdir, "apps")
+    app = os.path.join(apps, APP_NAME)
+    os.makedirs(os.path.join(app, "databases"), exist_ok=True)
+    open(os.path.join(apps, "__init__.py"), "a").close()
+    for name in os.listdir(APP_FOLDER):
+        link = os.path.join(app, name)
+        if name not in ("databases", "__pycache__") and not os.path.lexists(link):
+            os.symlink(os.path.join(APP_FOLDER, name), link)
+    return apps, app
+
+
+class Server:
+    def __init__(self, apps, port):
+        self.url = "http://127.0.0.1:%d/%s/" % (port, APP_NAME)
+        self.log = open(os.path.join(os.path.dirname(apps), "server.log"), "a")
+        self.process = subprocess.Popen(
+            ["py4web", "run", apps, "--port", str(port), "--watch", "off"],
+            stdout=self.log,
+            stderr=subprocess.STDOUT,
+        )
+        for _ in range(120):
+            try:
+                urllib.request.urlopen(self.url + "index", timeout=5)
+                return
+            except OSError:
+                time.sleep(0.5)
+        self.stop()
+        sys.exit("The app did not start, see %s" % self.log.name)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        self.log.close()
+
+
+class Client:
+    """An HTTP session logged in as the load test user"""
+
+    def __init__(self, url):
+        self.url = url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def request(self, path, params=None, data=None):
+        url = self.url + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        request = urllib.request.Request(url)
+        if data is not None:
+            request.data = json.dumps(data).encode()
+            request.add_header("Content-Type", "application/json")
+        with self.opener.open(request, timeout=300) as response:
+            body = response.read()
+        return json.loads(body) if path.startswith(("api/", "auth/", "checklist/")) else body
+
+    # Logs in, registering the user on a new database; returns the user id
+    def login(self):
+        credentials = dict(email=EMAIL, password=PASSWORD)
+        try:
+            return self.request("auth/api/login", data=credentials)["user"]["id"]
+        except urllib.error.HTTPError:
+            self.request(
+                "auth/api/register",
+                data=dict(credentials, first_name="Load", last_name="Test"),
+            )
+            return self.request("auth/api/login", data=credentials)["user"]["id"]
+
+
+# Copies of the sample checklists, moved around in space and time, until the
+# database holds the requested number of sightings
+def seed(db, sightings, user_id, user_checklists, chunk_size):
+    checklists, by_event = read_samples(db)
+    importer = dbpopulator.Importer(db, chunk_size)
+    marker = importer.marker
+    checklist_sql = (
+        "INSERT INTO checklist (event_id, latitude, longitude, date, observer_id, "
+        "duration_minutes) VALUES (%s);" % ", ".join([marker] * 6)
+    )
+    sighting_sql = "INSERT INTO sighting (event_id, species_id, count) VALUES (%s);" % (
+        ", ".join([marker] * 3)
+    )
+
+    rng = random.Random(0)
+    done = 0
+    copy = 0
+    checklist_rows, sighting_rows = [], []
+    while done < sightings:
+        for event_id, lat, lng, date, observer, duration in checklists:
+            if done >= sightings:
+                break
+            copy_id = "%s-%d" % (event_id, copy)
+            if user_checklists > 0:
+                observer = str(user_id)
+                user_checklists -= 1
+            elif copy:
+                observer = "%s-%d" % (observer, copy % 20)
+            checklist_rows.append(
+                (
+                    copy_id,
+                    lat + (rng.uniform(-0.5, 0.5) if copy else 0),
+                    lng + (rng.uniform(-0.5, 0.5) if copy else 0),
+                    date - datetime.timedelta(days=rng.randrange(365) if copy else 0),
+                    observer,
+                    duration,
+                )
+            )
+            for species_id, count in by_event.get(event_id, ()):
+                sighting_rows.append((copy_id, species_id, count))
+            done += len(by_event.get(event_id, ()))
+            if len(sighting_rows) >= chunk_size:
+                write_chunk(db, checklist_sql, checklist_rows, sighting_sql, sighting_rows)
+                checklist_rows, sighting_rows = [], []
+                sys.stdout.write("\rseeded %d sightings" % done)
+                sys.stdout.flush()
+        copy += 1
+    write_chunk(db, checklist_sql, checklist_rows, sighting_sql, sighting_rows)
+    print("\rseeded %d sightings" % done)
+
+
+def write_chunk(db, checklist_sql, checklist_rows, sighting_sql, sighting_rows):
+    cursor = db._adapter.cursor
+    cursor.executemany(checklist_sql, checklist_rows)
+    cursor.executemany(sighting_sql, sighting_rows)
+    db.commit()
+
+
+# Sample checklists as tuples, and event_id -> [(species_id, count)]
+def read_samples(db):
+    importer = dbpopulator.Importer(db, 1)
+    species_ids = importer.species_ids()
+    with open(os.path.join(SAMPLE_FOLDER, "species.csv"), newline="") as f:
+        rows = dbpopulator.csv.reader(f)
+        getters = dbpopulator.species_columns(next(rows))
+        for row in rows:
+            species_ids[getters["name"](row)]
+    db.commit()
+
+    checklists = []
+    with open(os.path.join(SAMPLE_FOLDER, "checklists.csv"), newline="") as f:
+        rows = dbpopulator.csv.reader(f)
+        getters = dbpopulator.checklist_columns(next(rows))
+        for row in rows:
+            checklists.append(tuple(get(row) for get in getters.values()))
+
+    by_event = {}
+    with open(os.path.join(SAMPLE_FOLDER, "sightings.csv"), newline="") as f:
+        rows = dbpopulator.csv.reader(f)
+        getters = dbpopulator.sighting_columns(next(rows), species_ids)
+        for row in rows:
+            event_id, species_id, count = (get(row) for get in getters.values())
+            by_event.setdefault(event_id, []).append((species_id, count))
+    db.commit()
+    return checklists, by_event
+
+
+def load_settings():
+    return dbpopulator.load_settings()
+
+
+# Request generators: client, random generator, species names -> (path, params, data)
+def random_bounds(rng):
+    lat, lng = rng.uniform(30, 45), rng.uniform(-120, -75)
+    size = rng.choice([0.05, 0.2, 1, 5])
+    return [lng - size, lat - size / 2, lng + size, lat + size / 2]
+
+
+def bounds_param(bounds):
+    return ",".join("%.5f" % value for value in bounds)
+
+
+def sightings_request(rng, species):
+    params = dict(bounds=bounds_param(random_bounds(rng)), zoom=rng.randrange(4, 12))
+    if rng.random() < 0.3:
+        params["list"] = rng.choice(species)
+    return "api/sightings", params, None
+
+
+def tile_request(rng, species):
+    z = rng.randrange(4, 12)
+    lat, lng = rng.uniform(30, 45), rng.uniform(-120, -75)
+    x = int((lng + 180) / 360 * 2**z)
+    y = int(
+        (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * 2**z
+    )
+    params = dict(search=rng.choice(species)[:4]) if rng.random() < 0.3 else None
+    return "api/sightings/tiles/%d/%d/%d" % (z, x, y), params, None
+
+
+def region_request(rng, species):
+    return "api/species_by_region", dict(bounds=bounds_param(random_bounds(rng))), None
+
+
+def trends_request(rng, species):
+    params = dict(
+        bounds=bounds_param(random_bounds(rng)),
+        species_name=rng.choice(species),
+        granularity=rng.choice(["day", "week", "month"]),
+    )
+    return "api/species_trends", params, None
+
+
+def contributors_request(rng, species):
+    return "api/top_contributors", dict(bounds=bounds_param(random_bounds(rng))), None
+
+
+def checklists_request(rng, species):
+    return "api/get_checklists", dict(limit=20), None
+
+
+def statistics_request(rng, species):
+    return "statistics", None, None
+
+
+def submit_request(rng, species):
+    lat, lng = rng.uniform(30, 45), rng.uniform(-120, -75)
+    counts = [
+        dict(name=name, count=rng.randrange(1, 20))
+        for name in rng.sample(species, rng.randrange(1, 40))
+    ]
+    return "checklist/submit", None, dict(lat=lat, lng=lng, duration=30, species=counts)
+
+
+REQUESTS = {
+    "api/sightings/tiles": tile_request,
+    "api/sightings": sightings_request,
+    "api/species_by_region": region_request,
+    "api/species_trends": trends_request,
+    "api/top_contributors": contributors_request,
+    "api/get_checklists": checklists_request,
+    "statistics": statistics_request,
+    "checklist/submit": submit_request,
+}
+
+
+class RSSMonitor:
+    """Samples the resident memory of a process, on Linux"""
+
+    def __init__(self, pid, interval=0.02):
+        self.path = "/proc/%d/status" % pid
+        self.interval = interval
+        self.peak = None
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def rss(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+
+    def run(self):
+        while self.running:
+            rss = self.rss()
+            if rss is not None:
+                self.peak = max(self.peak or 0, rss)
+            time.sleep(self.interval)
+
+    def reset(self):
+        self.peak = self.rss()
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+
+# Runs requests from concurrent logged in clients, returns stats per endpoint
+def replay(url, names, count, concurrency, species, monitor, seed):
+    rng = random.Random(seed)
+    weights = [MIX[name] for name in names]
+    plan = [rng.choices(names, weights)[0] for _ in range(count)]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+
+    def work(index):
+        client = Client(url)
+        client.login()
+        worker_rng = random.Random(seed * 1000 + index)
+        for name in plan[index::concurrency]:
+            path, params, data = REQUESTS[name](worker_rng, species)
+            start = time.perf_counter()
+            try:
+                result = client.request(path, params, data)
+                failed = isinstance(result, dict) and (
+                    "error" in result or result.get("success") is False
+                )
+            except Exception:
+                failed = True
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies[name].append(elapsed)
+                errors[name] += failed
+
+    monitor.reset()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=work, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    def summary(values, failed):
+        return dict(
+            requests=len(values),
+            errors=failed,
+            p50_ms=ms(percentile(values, 0.50)),
+            p95_ms=ms(percentile(values, 0.95)),
+            p99_ms=ms(percentile(values, 0.99)),
+            throughput_rps=round(len(values) / elapsed, 2),
+        )
+
+    result = {name: summary(latencies[name], errors[name]) for name in names}
+    total = summary(sum(latencies.values(), []), sum(errors.values()))
+    total["peak_rss_mb"] = round(monitor.peak / 2**20, 1) if monitor.peak else None
+    return result, total
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 2)
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="load_test_")
+    apps, app = make_app(workdir)
+    settings = load_settings()
+    uri = settings.DB_URI
+    folder = os.path.join(app, "databases")
+    marker = os.path.join(workdir, "seed.json")
+    seeded = os.path.exists(marker) and json.load(open(marker)) == vars_seed(args)
+
+    server = Server(apps, args.port)
+    try:
+        user_id = Client(server.url).login()
+        if not seeded:
+            # The app has created its tables, now fill them
+            db = DAL(uri, folder=folder, migrate_enabled=False)
+            for table in ("sighting", "checklist", "species_day"):
+                db.executesql("DELETE FROM %s;" % table)
+            db.commit()
+            seed(db, args.sightings, user_id, args.user_checklists, args.chunk_size)
+            db.close()
+            dbpopulator.rebuild_rollups(dbpopulator.load_app(app))
+            with open(marker, "w") as f:
+                json.dump(vars_seed(args), f)
+            # Start again so that no cache or memory from seeding is measured
+            server.stop()
+            server = Server(apps, args.port)
+
+        species = Client(server.url).request("api/species/search")["species"]
+        db = DAL(uri, folder=folder, migrate_enabled=False)
+        database = dict(
+            checklists=db.executesql("SELECT COUNT(*) FROM checklist;")[0][0],
+            sightings=db.executesql("SELECT COUNT(*) FROM sighting;")[0][0],
+        )
+        db.close()
+        monitor = RSSMonitor(server.process.pid)
+
+        endpoints = {}
+        for name in MIX:
+            print("%s..." % name)
+            result, total = replay(
+                server.url, [name], args.requests, args.concurrency, species, monitor, 1
+            )
+            endpoints[name] = total
+        print("mix...")
+        mix, total = replay(
+            server.url, list(MIX), args.mix_requests, args.concurrency, species, monitor, 2
+        )
+        monitor.running = False
+    finally:
+        server.stop()
+
+    report = dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        config=dict(
+            requests=args.requests,
+            mix_requests=args.mix_requests,
+            concurrency=args.concurrency,
+        ),
+        database=database,
+        endpoints=endpoints,
+        mix=dict(endpoints=mix, total=total),
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+
+
+def vars_seed(args):
+    return dict(sightings=args.sightings, user_checklists=args.user_checklists)
+
+
+# Prints the change of each endpoint's latencies between two reports
+def compare(args):
+    old, new = json.load(open(args.old)), json.load(open(args.new))
+    print("%-24s %8s %8s %8s %10s" % ("endpoint", "p50", "p95", "p99", "rps"))
+    for name, stats in new["endpoints"].items():
+        before = old["endpoints"].get(name)
+        if not before:
+            continue
+        print(
+            "%-24s %8s %8s %8s %10s"
+            % (
+                name,
+                ratio(before["p50_ms"], stats["p50_ms"]),
+                ratio(before["p95_ms"], stats["p95_ms"]),
+                ratio(before["p99_ms"], stats["p99_ms"]),
+                ratio(before["throughput_rps"], stats["throughput_rps"]),
+            )
+        )
+
+
+def ratio(before, after):
+    if not before or after is None:
+        return "-"
+    return "%.2fx" % (after / before)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="seed, start the app and replay requests")
+    run_parser.add_argument("--sightings", type=int, default=1000000)
+    run_parser.add_argument("--user-checklists", type=int, default=2000)
+    run_parser.add_argument("--workdir", help="keeps the seeded database between runs")
+    run_parser.add_argument("--port", type=int, default=8799)
+    run_parser.add_argument("--requests", type=int, default=200, help="per endpoint")
+    run_parser.add_argument("--mix-requests", type=int, default=1000)
+    run_parser.add_argument("--concurrency", type=int, default=4)
+    run_parser.add_argument("--chunk-size", type=int, default=50000)
+    run_parser.add_argument("--output", help="JSON report file")
+
+    compare_parser = commands.add_parser("compare", help="compare two JSON reports")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
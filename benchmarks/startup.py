@@ -0,0 +1,188 @@
+"""
+Startup benchmark for the app: cold import time and first-request latency.
+
+Runs a throwaway copy of the app, like load_test.py, on a copy of the app's
+database. Each run imports the app in a new interpreter, after py4web itself,
+which is loaded once for every app of a server. Then it starts py4web and,
+as soon as the server accepts connections, times the first request to each
+of FIRST_REQUESTS.
+
+    python benchmarks/startup.py
+    python benchmarks/startup.py --runs 10 --import-budget 0.3
+    python benchmarks/startup.py --new-database
+
+Prints the timings as JSON and exits with status 1 when the slowest import
+or a first request is over its budget, STARTUP_IMPORT_BUDGET and
+STARTUP_REQUEST_BUDGET in settings.py unless given.
+"""
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_NAME = os.path.basename(APP_FOLDER)
+
+spec = importlib.util.spec_from_file_location(
+    "load_test", os.path.join(APP_FOLDER, "benchmarks", "load_test.py")
+)
+load_test = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(load_test)
+
+# Requests of a visitor opening the map, which need no login
+FIRST_REQUESTS = [
+    "index",
+    "api/species/search?q=sparrow",
+    "api/sightings/tiles/4/2/6",
+    "api/sightings/clusters?bounds=-125,24,-66,50&zoom=4",
+]
+
+# Run in a new interpreter: prints the seconds taken to import the app
+IMPORT_SCRIPT = """
+import sys, time
+sys.path.insert(0, %r)
+import py4web.core
+start = time.perf_counter()
+import apps.%s
+print(time.perf_counter() - start, flush=True)
+"""
+
+
+# Copies the app's database into the copy of the app, or leaves it empty
+def copy_database(app, new_database):
+    source = os.path.join(APP_FOLDER, "databases")
+    target = os.path.join(app, "databases")
+    shutil.rmtree(target, ignore_errors=True)
+    os.makedirs(target)
+    if new_database:
+        return
+    for name in os.listdir(source):
+        if name.endswith(".table"):
+            shutil.copy(os.path.join(source, name), target)
+    settings = load_test.load_settings()
+    if not settings.DB_URI.startswith("sqlite://"):
+        sys.exit("Only a SQLite database can be copied, use --new-database")
+    # With its write-ahead log, which a plain copy would miss
+    name = settings.DB_URI[len("sqlite://") :]
+    original = sqlite3.connect(os.path.join(source, name))
+    copy = sqlite3.connect(os.path.join(target, name))
+    original.backup(copy)
+    copy.close()
+    original.close()
+
+
+def time_import(workdir):
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT % (workdir, APP_NAME)],
+        cwd=workdir,
+        capture_output=True,
+        text=True,
+    )
+    if output.returncode:
+        sys.exit("Importing the app failed:\n" + output.stderr)
+    return float(output.stdout.split()[-1])
+
+
+# Seconds from starting py4web until it accepts connections, then those of
+# each first request
+def time_first_requests(apps, port):
+    log = open(os.path.join(os.path.dirname(apps), "server.log"), "a")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        ["py4web", "run", apps, "--port", str(port), "--watch", "off"],
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if process.poll() is not None or time.perf_counter() - start > 120:
+                    sys.exit("The app did not start, see %s" % log.name)
+                time.sleep(0.01)
+        ready = time.perf_counter() - start
+
+        url = "http://127.0.0.1:%d/%s/" % (port, APP_NAME)
+        requests = {}
+        for path in FIRST_REQUESTS:
+            request_start = time.perf_counter()
+            with urllib.request.urlopen(url + path, timeout=300) as response:
+                response.read()
+            requests[path] = time.perf_counter() - request_start
+    finally:
+        process.terminate()
+        process.wait()
+        log.close()
+    return ready, requests
+
+
+def ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+def main():
+    settings = load_test.load_settings()
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--runs", type=int, default=5, help="imports to time")
+    parser.add_argument("--workdir", help="where the copy of the app goes")
+    parser.add_argument("--port", type=int, default=8798)
+    parser.add_argument(
+        "--new-database", action="store_true", help="start from an empty database"
+    )
+    parser.add_argument(
+        "--import-budget", type=float, default=settings.STARTUP_IMPORT_BUDGET
+    )
+    parser.add_argument(
+        "--request-budget", type=float, default=settings.STARTUP_REQUEST_BUDGET
+    )
+    parser.add_argument("--output", help="JSON report file")
+    args = parser.parse_args()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="startup_")
+    apps, app = load_test.make_app(workdir)
+    copy_database(app, args.new_database)
+    # The first import creates a new database, the next ones find it
+    imports = [time_import(workdir) for _ in range(args.runs)]
+    ready, requests = time_first_requests(apps, args.port)
+
+    over = []
+    if max(imports) > args.import_budget:
+        over.append("import")
+    over += [path for path, seconds in requests.items() if seconds > args.request_budget]
+    report = dict(
+        date=datetime.datetime.now().isoformat(timespec="seconds"),
+        database="new" if args.new_database else "copy",
+        budgets_ms={"import": ms(args.import_budget), "request": ms(args.request_budget)},
+        import_ms=dict(
+            runs=[ms(s) for s in imports],
+            median=ms(statistics.median(imports)),
+            max=ms(max(imports)),
+        ),
+        ready_ms=ms(ready),
+        first_request_ms={path: ms(s) for path, s in requests.items()},
+        over_budget=over,
+    )
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    print(output)
+    if over:
+        sys.exit("Over budget: %s" % ", ".join(over))
+
+
+if __name__ == "__main__":
+    main()
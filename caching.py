@@ -0,0 +1,252 @@
+"""
+This file defines the caches used by the map endpoints
+"""
+
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from . import grid
+
+try:
+    import fcntl
+except ImportError:  # Windows runs a single worker process
+    fcntl = None
+
+
+class SharedCounter:
+    """
+    Data generation and the time it last changed, in a memory-mapped file, so
+    that every worker process of the app sees the writes of the others
+    """
+
+    FORMAT = "<qd"  # generation, time of the last increment
+
+    def __init__(self, path):
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = struct.calcsize(self.FORMAT)
+        if os.fstat(self.fd).st_size < size:
+            os.ftruncate(self.fd, size)
+        self.map = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()
+
+    def read(self):
+        return struct.unpack_from(self.FORMAT, self.map)
+
+    # Returns the new generation
+    def increment(self):
+        with self.lock:
+            if fcntl:
+                fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                generation = self.read()[0] + 1
+                struct.pack_into(self.FORMAT, self.map, 0, generation, time.time())
+            finally:
+                if fcntl:
+                    fcntl.flock(self.fd, fcntl.LOCK_UN)
+        return generation
+
+
+class LocalCounter:
+    """Data generation of a single process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = (0, time.time())
+
+    def read(self):
+        return self.value
+
+    def increment(self):
+        with self.lock:
+            self.value = (self.value[0] + 1, time.time())
+            return self.value[0]
+
+
+class TileCache:
+    """
+    LRU cache of rendered map tiles keyed by (z, x, y, filter).
+    Tiles are dropped when a checklist inside them changes. The whole cache is
+    dropped when another process changed the data, since it can't tell where.
+    """
+
+    def __init__(self, size=4096, counter=None):
+        self.size = size
+        self.counter = counter or LocalCounter()
+        self.lock = threading.Lock()
+        self.tiles = OrderedDict()
+        self.filters = {}  # (z, x, y) -> filters cached for that tile
+        self.zooms = {}  # z -> number of (z, x, y) entries in self.filters
+        self.generation = self.counter.read()[0]  # last one accounted for
+
+    def get(self, key, callback):
+        generation = self.counter.read()[0]
+        with self.lock:
+            if generation != self.generation:
+                self._clear()
+                self.generation = generation
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+        value = callback()
+        with self.lock:
+            if generation != self.generation:
+                return value
+            if key not in self.tiles:
+                self._add(key)
+            self.tiles[key] = value
+            self.tiles.move_to_end(key)
+            while len(self.tiles) > self.size:
+                self._drop(next(iter(self.tiles)))
+        return value
+
+    # Drop every cached tile, for any filter, that contains one of the points
+    # changed by the write that made generation
+    def invalidate(self, points, generation):
+        with self.lock:
+            if generation != self.generation + 1:
+                # Other writes came in between
+                self._clear()
+            else:
+                for lat, lng in points:
+                    for z in list(self.zooms):
+                        tile = (z,) + grid.tile_index(lat, lng, z)
+                        for filter in list(self.filters.get(tile, ())):
+                            self._drop(tile + (filter,))
+            self.generation = max(self.generation, generation)
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def _clear(self):
+        self.tiles.clear()
+        self.filters.clear()
+        self.zooms.clear()
+
+    def _add(self, key):
+        tile, filter = key[:3], key[3]
+        if tile not in self.filters:
+            self.filters[tile] = set()
+            self.zooms[tile[0]] = self.zooms.get(tile[0], 0) + 1
+        self.filters[tile].add(filter)
+
+    def _drop(self, key):
+        del self.tiles[key]
+        tile, filter = key[:3], key[3]
+        self.filters[tile].discard(filter)
+        if not self.filters[tile]:
+            del self.filters[tile]
+            self.zooms[tile[0]] -= 1
+            if not self.zooms[tile[0]]:
+                del self.zooms[tile[0]]
+
+
+class ResultCache:
+    """
+    LRU cache of API results tagged with the data generation they were computed
+    from. Writes bump the generation, so a result older than the last write is
+    never served. Within a generation, results older than ttl are served stale
+    for up to stale_ttl while a single caller recomputes them.
+    """
+
+    def __init__(self, size=1000, ttl=3600, stale_ttl=86400, counter=None):
+        self.size = size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.counter = counter or LocalCounter()
+        # A start counts as a write, since the data may have changed meanwhile
+        self.counter.increment()
+        self.lock = threading.Lock()
+        self.results = OrderedDict()  # key -> (generation, time, value)
+        self.refreshing = set()  # keys being recomputed
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    @property
+    def generation(self):
+        return self.counter.read()[0]
+
+    @property
+    def modified(self):
+        return self.counter.read()[1]
+
+    # Call after every write that can change a cached result; returns the
+    # new generation
+    def bump(self):
+        return self.counter.increment()
+
+    def get(self, key, callback):
+        now = time.time()
+        generation = self.generation
+        with self.lock:
+            entry = self.results.get(key)
+            if entry and entry[0] == generation:
+                age = now - entry[1]
+                if age < self.ttl:
+                    self.hits += 1
+                    self.results.move_to_end(key)
+                    return entry[2]
+                if age < self.stale_ttl and key in self.refreshing:
+                    self.stale_hits += 1
+                    return entry[2]
+            self.misses += 1
+            self.refreshing.add(key)
+        try:
+            value = callback()
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+        self.store(key, generation, now, value)
+        return value
+
+    # Cache a value computed from the data of generation, at time now
+    def store(self, key, generation, now, value):
+        with self.lock:
+            # A write during the computation makes the value outdated already
+            if generation == self.generation:
+                self.results[key] = (generation, now, value)
+                self.results.move_to_end(key)
+                while len(self.results) > self.size:
+                    self.results.popitem(last=False)
+
+    # The fresh cached value of key, or None, without computing it
+    def peek(self, key):
+        generation = self.generation
+        with self.lock:
+            entry = self.results.get(key)
+            if entry and entry[0] == generation and time.time() - entry[1] < self.ttl:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return entry[2]
+        return None
+
+    # Pass rows through, as they are read, then cache them as a list under key
+    # once all are read, unless a write came in meanwhile
+    def filling(self, key, rows):
+        now = time.time()
+        generation = self.generation
+        with self.lock:
+            self.misses += 1
+        value = []
+        for row in rows:
+            value.append(row)
+            yield row
+        self.store(key, generation, now, value)
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                generation=self.generation,
+                entries=len(self.results),
+                hits=self.hits,
+                stale_hits=self.stale_hits,
+                misses=self.misses,
+            )
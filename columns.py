@@ -0,0 +1,381 @@
+"""
+This file defines an optional in-memory copy of the checklist and sighting
+tables, kept as NumPy columns, for read-heavy deployments. It is enabled with
+USE_COLUMN_STORE in settings.py and needs "pip install numpy".
+
+Once loaded, it answers the queries decorated with common.columnar with
+vectorized masks and bincount instead of SQL. Checklists are rows of their own
+columns; their sightings are stored contiguously, from start to stop, in the
+sighting columns (a CSR index), so per-checklist sums are prefix-sum
+differences. Submits and deletes are applied with update() once committed.
+With COLUMN_STORE_CHECK, every answer is also computed by the DAL query, and
+differences are logged; a write between its commit and its update() shows up
+as a passing difference.
+
+Writes made by other worker processes don't reach this copy. It only answers
+while the shared data generation is the one it accounts for, and otherwise
+asks for a reload through on_stale.
+"""
+
+import datetime
+import threading
+import types
+import numpy as np
+from . import grid
+
+EPOCH = datetime.datetime(1970, 1, 1)
+DAY = 86400  # seconds
+
+CHECKLIST_COLUMNS = {
+    "id": np.int64,
+    "lat": np.float64,
+    "lng": np.float64,
+    "time": np.int64,  # seconds since EPOCH
+    "observer": np.int64,  # index in ColumnStore.observers
+    "alive": np.bool_,  # False once deleted
+    "start": np.int64,  # first sighting
+    "stop": np.int64,  # after the last sighting
+}
+SIGHTING_COLUMNS = {
+    "checklist": np.int64,  # checklist row
+    "species": np.int64,
+    "count": np.int64,
+}
+
+
+class Columns:
+    """Growable set of equal-length NumPy columns"""
+
+    def __init__(self, dtypes, size=0, capacity=1024):
+        self.size = size
+        capacity = max(capacity, size)
+        self.arrays = {
+            name: np.zeros(capacity, dtype) for name, dtype in dtypes.items()
+        }
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def append(self, rows):
+        names = list(self.arrays)
+        size = self.size + len(rows)
+        capacity = len(self.arrays[names[0]])
+        if size > capacity:
+            # Double, so appending one row at a time stays linear overall
+            capacity = max(size, 2 * capacity)
+            for name, array in self.arrays.items():
+                grown = np.zeros(capacity, array.dtype)
+                grown[: self.size] = array[: self.size]
+                self.arrays[name] = grown
+        for name, values in zip(names, zip(*rows)):
+            self.arrays[name][self.size : size] = values
+        self.size = size
+
+    # The used part of every column, unaffected by later appends
+    def view(self):
+        return types.SimpleNamespace(
+            **{name: array[: self.size] for name, array in self.arrays.items()}
+        )
+
+
+class ColumnStore:
+    def __init__(self, db, logger, counter, check=False):
+        self.db = db
+        self.logger = logger
+        self.counter = counter  # caching.SharedCounter of the data generation
+        self.check = check
+        self.lock = threading.Lock()
+        self.ready = False
+        self.loading = False
+        self.on_stale = None  # called, without arguments, to schedule a load
+        self.version = 0  # updates applied so far
+        self.generation = None  # data generation the columns account for
+        self.observers = []  # observer_id by index
+        self.observer_index = {}  # observer_id -> index
+
+    # Read both tables, retrying until no update came in meanwhile
+    def load(self):
+        with self.lock:
+            self.loading = True
+        try:
+            while True:
+                with self.lock:
+                    version = self.version
+                generation = self.counter.read()[0]
+                checklists, sightings, observers = self.read()
+                with self.lock:
+                    if version == self.version:
+                        self.checklists, self.sightings = checklists, sightings
+                        self.observers = observers
+                        self.observer_index = {o: i for i, o in enumerate(observers)}
+                        self.generation = generation
+                        self.ready = True
+                        return
+        finally:
+            with self.lock:
+                self.loading = False
+
+    # Whether the columns hold the current data; when a write of another
+    # process got in, they are reloaded
+    def current(self):
+        if not self.ready:
+            return False
+        if self.generation == self.counter.read()[0]:
+            return True
+        with self.lock:
+            # Writes of this process change it and the columns under the lock
+            if self.generation == self.counter.read()[0]:
+                return True
+            reload = not self.loading and self.on_stale
+            self.loading = True
+        if reload:
+            self.on_stale()
+        return False
+
+    def read(self):
+        rows = self.db.executesql(
+            "SELECT id, latitude, longitude, date, observer_id FROM checklist "
+            "ORDER BY id;"
+        )
+        observer_index = {}
+        checklists = Columns(CHECKLIST_COLUMNS, len(rows))
+        if rows:
+            ids, lats, lngs, dates, observers = zip(*rows)
+            checklists["id"][:] = ids
+            checklists["lat"][:] = np.array(lats, dtype=np.float64)
+            checklists["lng"][:] = np.array(lngs, dtype=np.float64)
+            checklists["time"][:] = np.array(dates, dtype="datetime64[s]").astype(
+                np.int64
+            )
+            checklists["observer"][:] = [
+                observer_index.setdefault(observer, len(observer_index))
+                for observer in observers
+            ]
+            checklists["alive"][:] = True
+
+        rows = self.db.executesql(
+            "SELECT checklist.id, sighting.species_id, sighting.count "
+            "FROM sighting JOIN checklist ON sighting.event_id = checklist.event_id "
+            "ORDER BY checklist.id;"
+        )
+        sightings = Columns(SIGHTING_COLUMNS, len(rows))
+        if rows:
+            checklist_ids, species, counts = zip(*rows)
+            ids = checklists["id"][: checklists.size]
+            sightings["checklist"][:] = np.searchsorted(ids, checklist_ids)
+            sightings["species"][:] = [-1 if s is None else s for s in species]
+            sightings["count"][:] = [c or 0 for c in counts]
+        # Sightings are sorted by checklist, so each one's are contiguous
+        sighting_rows = sightings["checklist"][: sightings.size]
+        checklist_rows = np.arange(checklists.size)
+        checklists["start"][: checklists.size] = np.searchsorted(
+            sighting_rows, checklist_rows, "left"
+        )
+        checklists["stop"][: checklists.size] = np.searchsorted(
+            sighting_rows, checklist_rows, "right"
+        )
+        return checklists, sightings, list(observer_index)
+
+    # Apply committed changes, as (checklist, sightings, sign) tuples, then
+    # call bump for the new data generation, which is returned
+    def update(self, changes, bump):
+        with self.lock:
+            self.version += 1
+            if self.ready:
+                for change in changes:
+                    self.apply(*change)
+            generation = bump()
+            if self.generation is not None and generation == self.generation + 1:
+                self.generation = generation
+            return generation
+
+    # Add (sign=1) or remove (sign=-1) a checklist and its sightings, like
+    # rollups.update. Applying the same change twice has no effect.
+    def apply(self, checklist, sightings, sign=1):
+        row = self.find(checklist.id)
+        if sign < 0:
+            if row is not None:
+                self.checklists["alive"][row] = False
+            return
+        if row is not None:
+            return
+        observer = self.observer_index.get(checklist.observer_id)
+        if observer is None:
+            observer = self.observer_index[checklist.observer_id] = len(
+                self.observers
+            )
+            self.observers.append(checklist.observer_id)
+        start = self.sightings.size
+        self.sightings.append(
+            [
+                (self.checklists.size, sighting.species_id, sighting.count or 0)
+                for sighting in sightings
+            ]
+        )
+        self.checklists.append(
+            [
+                (
+                    checklist.id,
+                    checklist.latitude,
+                    checklist.longitude,
+                    (checklist.date - EPOCH) // datetime.timedelta(seconds=1),
+                    observer,
+                    True,
+                    start,
+                    self.sightings.size,
+                )
+            ]
+        )
+
+    # Row of the live checklist with this id, or None. Ids only grow, but
+    # SQLite may reuse the id of the newest checklist once it is deleted.
+    def find(self, checklist_id):
+        ids = self.checklists["id"][: self.checklists.size]
+        left = np.searchsorted(ids, checklist_id, "left")
+        right = np.searchsorted(ids, checklist_id, "right")
+        for row in range(left, right):
+            if self.checklists["alive"][row]:
+                return row
+        return None
+
+    def views(self):
+        with self.lock:
+            return self.checklists.view(), self.sightings.view()
+
+    # Answer with the method named like the DAL query func
+    def answer(self, func, *args):
+        result = getattr(self, func.__name__)(*args)
+        if self.check:
+            expected = func(*args)
+            if not same(result, expected):
+                self.logger.warning(
+                    "Column store differs on %s%r:\n%r\nDAL:\n%r"
+                    % (func.__name__, args, result, expected)
+                )
+        return result
+
+    # Boolean mask of the sightings of the species, all of them for None
+    def species_mask(self, s, species_ids):
+        if species_ids is None:
+            return np.ones(len(s.species), np.bool_)
+        return np.isin(s.species, np.array(species_ids, dtype=np.int64))
+
+    # Matching sightings and their total count, per checklist, from the CSR index
+    def per_checklist(self, c, s, mask):
+        matches = np.concatenate(([0], np.cumsum(mask)))
+        totals = np.concatenate(([0], np.cumsum(np.where(mask, s.count, 0))))
+        return matches[c.stop] - matches[c.start], totals[c.stop] - totals[c.start]
+
+    # Boolean mask of the live checklists inside the bounds, see checklist_in_bounds
+    def in_bounds(self, c, bounds, half_open=False):
+        with np.errstate(invalid="ignore"):
+            if half_open:
+                mask = (c.lng >= bounds[0]) & (c.lat >= bounds[1])
+            else:
+                mask = (c.lng > bounds[0]) & (c.lat > bounds[1])
+            mask &= (c.lng < bounds[2]) & (c.lat < bounds[3])
+        return mask & c.alive
+
+    # Boolean mask of the checklists in a periods.Period, see models.in_period
+    def in_period(self, c, period):
+        mask = np.ones(len(c.time), np.bool_)
+        if period is None:
+            return mask
+        if period.start:
+            mask &= c.time >= (period.start - EPOCH.date()).days * DAY
+        if period.stop:
+            mask &= c.time < (period.stop - EPOCH.date()).days * DAY
+        if period.months:
+            months = c.time.astype("datetime64[s]").astype("datetime64[M]")
+            months = months.astype(np.int64) % 12 + 1
+            mask &= np.isin(months, np.array(period.months, dtype=np.int64))
+        return mask
+
+    def all_sightings(self, species_ids, period=None):
+        c, s = self.views()
+        matches, totals = self.per_checklist(c, s, self.species_mask(s, species_ids))
+        rows = np.flatnonzero((matches > 0) & c.alive & self.in_period(c, period))
+        columns = (c.lat[rows], c.lng[rows], totals[rows])
+        return [list(row) for row in zip(*(column.tolist() for column in columns))]
+
+    def grid_cells(self, species_ids, bounds, size, period=None):
+        c, s = self.views()
+        matches, totals = self.per_checklist(c, s, self.species_mask(s, species_ids))
+        mask = self.in_bounds(c, bounds, half_open=True) & self.in_period(c, period)
+        rows = np.flatnonzero(mask & (matches > 0))
+        lat, lng = c.lat[rows], c.lng[rows]
+        lat_cell = ((lat + 90) / size).astype(np.int64)
+        lng_cell = ((lng + 180) / size).astype(np.int64)
+        cells, cell = np.unique(
+            lat_cell * (int(360 / size) + 2) + lng_cell, return_inverse=True
+        )
+        # The SQL averages over joined sighting rows, so weigh by matches
+        weights = matches[rows]
+        n = np.bincount(cell, weights, len(cells))
+        return [
+            list(row)
+            for row in zip(
+                (np.bincount(cell, lat * weights, len(cells)) / n).tolist(),
+                (np.bincount(cell, lng * weights, len(cells)) / n).tolist(),
+                np.bincount(cell, totals[rows], len(cells)).astype(np.int64).tolist(),
+            )
+        ]
+
+    def species_totals(self, bounds, period=None):
+        c, s = self.views()
+        mask = (self.in_bounds(c, bounds) & self.in_period(c, period))[s.checklist]
+        species = s.species[mask]
+        present = np.bincount(species + 1)
+        totals = np.bincount(species + 1, s.count[mask]).astype(np.int64)
+        # Shifted by one, so that missing species (-1) can be counted too
+        return [
+            (int(index) - 1 if index else None, int(totals[index]))
+            for index in np.flatnonzero(present)
+        ]
+
+    def species_trend(self, species_id, bounds, granularity="day", period=None):
+        from .rollups import GRANULARITIES  # rollups imports common, which imports this
+
+        bucket = GRANULARITIES[granularity]
+        c, s = self.views()
+        mask = self.in_bounds(c, grid.clip_bounds(bounds)) & self.in_period(c, period)
+        mask = mask[s.checklist] & (s.species == species_id)
+        days, day = np.unique(c.time[s.checklist[mask]] // DAY, return_inverse=True)
+        day_totals = np.bincount(day, s.count[mask], len(days)).astype(np.int64)
+        totals = {}
+        for days_since_epoch, total in zip(days.tolist(), day_totals.tolist()):
+            key = bucket((EPOCH + datetime.timedelta(days=days_since_epoch)).date())
+            totals[key] = totals.get(key, 0) + total
+        return sorted(totals.items())
+
+    def top_contributors(self, bounds, period=None, limit=5):
+        c, s = self.views()
+        mask = self.in_bounds(c, grid.clip_bounds(bounds)) & self.in_period(c, period)
+        observers = c.observer[mask]
+        counts = np.bincount(observers)
+        nonzero = np.flatnonzero(counts)
+        if len(nonzero) > limit:
+            # Keep everyone tied with the limit-th largest count, then sort few
+            threshold = np.partition(counts[nonzero], -limit)[-limit]
+            nonzero = nonzero[counts[nonzero] >= threshold]
+        top = sorted(
+            (-int(counts[o]), self.observers[o]) for o in nonzero.tolist()
+        )[:limit]
+        return [(observer_id, -count) for count, observer_id in top]
+
+
+# Whether two results are equal up to row order and float rounding
+def same(a, b):
+    return normalize(a) == normalize(b)
+
+
+# Sorted rows, with floats rounded
+def normalize(rows):
+    def value(v):
+        return round(v, 6) if isinstance(v, float) else v
+
+    rows = [
+        [value(v) for v in row] if isinstance(row, (list, tuple)) else value(row)
+        for row in rows
+    ]
+    return sorted(rows, key=repr)
@@ -3,17 +3,25 @@ This file defines cache, session, and translator T object for the app
 These are fixtures that every app needs so probably you will not be editing this file
 """
 import copy
+import functools
 import os
+import secrets
 import sys
 import logging
+import threading
 from py4web import Session, Cache, Translator, Flash, DAL, Field, action
-from py4web.utils.mailer import Mailer
+from py4web.core import Fixture
 from py4web.utils.auth import Auth
 from py4web.utils.downloader import downloader
 from pydal.tools.tags import Tags
 from py4web.utils.factories import ActionFactory
 from py4web.utils.form import FormStyleBulma
-from . import settings
+from pydal.connection import ConnectionPool
+from . import settings, grid
+from .caching import ResultCache, TileCache, SharedCounter
+from .conditional import ConditionalGet
+from .instrumentation import Instrumentation
+from .scheduling import LocalScheduler
 
 # #######################################################
 # implement custom loggers form settings.LOGGERS
@@ -35,26 +43,220 @@ for item in settings.LOGGERS:
 # #######################################################
 # connect to db
 # #######################################################
-db = DAL(
+# With the write-ahead log, readers don't wait for the writer, nor the writer
+# for readers; it only needs a sync at checkpoints
+def sqlite_wal(adapter):
+    adapter.execute("PRAGMA journal_mode=WAL;")
+    adapter.execute("PRAGMA synchronous=NORMAL;")
+
+
+class ThreadSafeDAL(DAL):
+    """
+    DAL whose lazy tables are each defined once, by one thread. pydal takes a
+    table off its lazy ones before defining it, so another thread using it
+    meanwhile wouldn't find it. The lock is reentrant since defining a table
+    defines those it references.
+    """
+
+    lock = threading.RLock()
+
+    def __getattr__(self, key):
+        if key[:1] == "_" or key not in object.__getattribute__(self, "tables"):
+            return super().__getattr__(key)
+        with ThreadSafeDAL.lock:
+            try:
+                return object.__getattribute__(self, key)  # defined meanwhile
+            except AttributeError:
+                return super().__getattr__(key)
+
+
+# In case another thread was defining a table at the time of a fork
+os.register_at_fork(
+    after_in_child=lambda: setattr(ThreadSafeDAL, "lock", threading.RLock())
+)
+
+sqlite = settings.DB_URI.startswith("sqlite:")
+db = ThreadSafeDAL(
     settings.DB_URI,
     folder=settings.DB_FOLDER,
     pool_size=settings.DB_POOL_SIZE,
     migrate=settings.DB_MIGRATE,
     fake_migrate=settings.DB_FAKE_MIGRATE,
+    after_connection=sqlite_wal if sqlite else None,
+    lazy_tables=True,
 )
+if sqlite:
+    # pydal never pools SQLite connections, but opening one per request costs
+    # more than most of the queries run on it
+    db._adapter.pool_size = settings.DB_POOL_SIZE
+
+
+# "py4web run -w N" and gunicorn fork their workers after loading the app.
+# Connections can't be shared with the children, so they are closed first.
+def close_connections():
+    db._adapter.close()  # into the pool
+    for connection in ConnectionPool.POOLS.pop(db._adapter.uri, []):
+        connection.close()
+
+
+# Objects guarding their state with a lock get a new one in forked workers,
+# in case another thread held it at the time of the fork
+def fork_safe(obj):
+    os.register_at_fork(after_in_child=lambda: setattr(obj, "lock", threading.Lock()))
+    return obj
+
+
+os.register_at_fork(before=close_connections)
+
+# #######################################################
+# Start the background jobs on the first request of each process
+# #######################################################
+class Startup(Fixture):
+    """
+    Runs the functions given to register() once per process, before its first
+    request, rather than when the app is imported: forked workers each run
+    them, and scripts importing the app don't. A prerequisite of db, so that
+    every action using the database triggers it.
+
+    The functions given to preload() load read-only data once, in the process
+    that forks the workers, right before its first fork: the workers then
+    share its pages rather than each loading a copy. Without a fork they
+    don't run, and the data loads in each process as it is first needed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.functions = []
+        self.done = False
+        self.loaders = []
+        self.preloaded = False
+        os.register_at_fork(before=self.before_fork)
+
+    def register(self, func):
+        self.functions.append(func)
+        return func
+
+    def preload(self, func):
+        self.loaders.append(func)
+        return func
+
+    # Before close_connections, which was registered first
+    def before_fork(self):
+        if self.preloaded:
+            return
+        self.preloaded = True
+        for func in self.loaders:
+            func()
+
+    def on_request(self, context):
+        if self.done:
+            return
+        with self.lock:
+            if self.done:
+                return
+            self.done = True
+        for func in self.functions:
+            func()
+
+
+startup = fork_safe(Startup())
+db.__prerequisites__ = (startup,)
 
 # #######################################################
 # define global objects that may or may not be used by the actions
 # #######################################################
 cache = Cache(size=1000)
+# Bumped by every write, in any worker process of this host
+data_generation = fork_safe(
+    SharedCounter(os.path.join(settings.DB_FOLDER, "data_generation"))
+)
+tile_cache = fork_safe(TileCache(size=settings.TILE_CACHE_SIZE, counter=data_generation))
+result_cache = fork_safe(
+    ResultCache(
+        size=settings.RESULT_CACHE_SIZE,
+        ttl=settings.RESULT_CACHE_TTL,
+        stale_ttl=settings.RESULT_CACHE_STALE_TTL,
+        counter=data_generation,
+    )
+)
+instrumentation = Instrumentation(
+    db, logger, slow_query=settings.SLOW_QUERY_SECONDS, query_log=settings.QUERY_LOG
+)
+fork_safe(instrumentation.metrics)
+
+if settings.USE_COLUMN_STORE:
+    from .columns import ColumnStore
+
+    column_store = fork_safe(
+        ColumnStore(db, logger, data_generation, check=settings.COLUMN_STORE_CHECK)
+    )
+else:
+    column_store = None
+
+
+# Fixtures for @action.uses(*instrumented(...)): the instrumentation wraps the
+# given fixtures, and its marker is innermost, around the action itself
+def instrumented(*fixtures):
+    return (instrumentation,) + fixtures + (instrumentation.action,)
+
+
+# Decorator for a DAL query that column_store can answer, with a method of the
+# same name and arguments, once it is loaded
+def columnar(func):
+    @functools.wraps(func)
+    def wrapper(*args):
+        if column_store is None or not column_store.current():
+            return func(*args)
+        return column_store.answer(func, *args)
+
+    return wrapper
+
+
+# Conditional GET for read-only actions, listed before db so that a 304 skips
+# it. The public ones come first; region_validator, for logged-in users only,
+# comes after auth.user, so that no 304 answers before the login check. Map
+# data changes with every write, so clients revalidate each time; species
+# names only change with imports.
+map_validator = ConditionalGet(
+    result_cache, "public, no-cache", normalizers={"bounds": grid.parse_bounds}
+)
+region_validator = ConditionalGet(
+    result_cache, "private, no-cache", normalizers={"bounds": grid.parse_bounds}
+)
+species_validator = ConditionalGet(result_cache, "public, max-age=300")
+
+
 T = Translator(settings.T_FOLDER)
 flash = Flash()
 
 # #######################################################
 # pick the session type that suits you best
 # #######################################################
+# SESSION_SECRET_KEY, or the random key of this databases folder. The first
+# process to start writes it; others starting meanwhile keep the one linked first.
+def session_secret():
+    if settings.SESSION_SECRET_KEY:
+        return settings.SESSION_SECRET_KEY
+    path = os.path.join(settings.DB_FOLDER, "session_secret")
+    if not os.path.exists(path):
+        temp = "%s.%d" % (path, os.getpid())
+        fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with open(fd, "w") as f:
+            f.write(secrets.token_hex(32))
+        try:
+            os.link(temp, path)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(temp)
+    with open(path) as f:
+        return f.read().strip()
+
+
+secret = session_secret()
+
 if settings.SESSION_TYPE == "cookies":
-    session = Session(secret=settings.SESSION_SECRET_KEY)
+    session = Session(secret=secret)
 elif settings.SESSION_TYPE == "redis":
     import redis
 
@@ -66,16 +268,16 @@ elif settings.SESSION_TYPE == "redis":
         if ct(k) >= 0
         else cs(k, v, e)
     )
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    session = Session(secret=secret, storage=conn)
 elif settings.SESSION_TYPE == "memcache":
     import memcache, time
 
     conn = memcache.Client(settings.MEMCACHE_CLIENTS, debug=0)
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=conn)
+    session = Session(secret=secret, storage=conn)
 elif settings.SESSION_TYPE == "database":
     from py4web.utils.dbstore import DBStore
 
-    session = Session(secret=settings.SESSION_SECRET_KEY, storage=DBStore(db))
+    session = Session(secret=secret, storage=DBStore(db))
 
 # #######################################################
 # Instantiate the object and actions that handle auth
@@ -115,6 +317,8 @@ auth.define_tables()
 # Configure email sender for auth
 # #######################################################
 if settings.SMTP_SERVER:
+    from py4web.utils.mailer import Mailer
+
     auth.sender = Mailer(
         server=settings.SMTP_SERVER,
         sender=settings.SMTP_SENDER,
@@ -192,6 +396,9 @@ if settings.UPLOAD_FOLDER:
 # #######################################################
 # Optionally configure celery
 # #######################################################
+# jobs that work on this process' memory, like warming its caches, always run
+# on the local pool; the others go to Celery when it is enabled
+local_scheduler = LocalScheduler(workers=settings.LOCAL_SCHEDULER_WORKERS, logger=logger)
 if settings.USE_CELERY:
     from celery import Celery
 
@@ -200,6 +407,8 @@ if settings.USE_CELERY:
     scheduler = Celery(
         "apps.%s.tasks" % settings.APP_NAME, broker=settings.CELERY_BROKER
     )
+else:
+    scheduler = local_scheduler
 
 
 # #######################################################
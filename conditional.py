@@ -0,0 +1,82 @@
+"""
+This file defines a fixture for conditional GET on read-only actions. The
+response's ETag is derived from the data generation of common.result_cache and
+the normalized request, so a client that already has the current data gets a
+304 before the action runs, and on public actions before the database and the
+session are touched.
+
+    @action.uses(*instrumented(revalidated, db))  # see common.py
+    @action.uses(*instrumented(db, auth.user, revalidated))  # logged-in users only
+
+It must come before the fixtures it should skip, like db, but after those that
+check access, like auth.user: a 304 also tells when the data last changed.
+"""
+
+import hashlib
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from py4web import request, response
+from py4web.core import Fixture, HTTP
+
+
+class ConditionalGet(Fixture):
+    def __init__(self, cache, cache_control="private, no-cache", normalizers=None):
+        self.cache = cache
+        self.cache_control = cache_control
+        self.normalizers = normalizers or {}  # parameter -> function of its value
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.headers = None
+        if request.method not in ("GET", "HEAD"):
+            return
+        generation, modified = self.cache.generation, self.cache.modified
+        headers = {
+            "ETag": self.etag(generation, modified),
+            "Last-Modified": formatdate(modified, usegmt=True),
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept",
+        }
+        self.local.headers = headers
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            fresh = headers["ETag"] in if_none_match or if_none_match.strip() == "*"
+        else:
+            fresh = not_modified_since(request.headers.get("If-Modified-Since"), modified)
+        if fresh:
+            raise HTTP(304, headers=headers)
+
+    def on_success(self, context):
+        headers = self.local.headers
+        if headers and response.status_code == 200:
+            response.headers.update(headers)
+
+    # Strong validator: same data generation, same request, same bytes
+    def etag(self, generation, modified):
+        query = []
+        for key in sorted(request.query):
+            value = request.query.get(key)
+            if key in self.normalizers:
+                value = self.normalizers[key](value)
+            query.append((key, value))
+        key = repr(
+            (
+                generation,
+                modified,
+                request.path,
+                query,
+                request.headers.get("Accept", ""),
+            )
+        )
+        return '"%s"' % hashlib.blake2b(key.encode("utf8"), digest_size=16).hexdigest()
+
+
+# Whether If-Modified-Since is at or after the data's last change
+def not_modified_since(header, modified):
+    if not header:
+        return False
+    try:
+        since = mktime_tz(parsedate_tz(header))
+    except (TypeError, ValueError):
+        return False
+    return since >= int(modified) and since <= time.time()
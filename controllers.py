@@ -31,42 +31,42 @@ from .common import (
     db,
     session,
     T,
-    cache,
+    tile_cache,
+    result_cache,
+    instrumented,
+    instrumentation,
+    columnar,
+    column_store,
+    map_validator,
+    region_validator,
+    species_validator,
     auth,
     logger,
     authenticated,
     unauthenticated,
     flash,
+    settings,
 )
 from py4web.utils.url_signer import URLSigner
 from py4web.utils.form import Form, FormStyleBulma
 from pydal.validators import *
-from .models import get_user_email
-from datetime import datetime
+from .models import get_user_email, checklist_in_bounds, in_period, insert_rows
+from .user_stats import user_statistics
+from .heatmap import species_search_ids, species_search_filter, grid_cells
+from .grid import parse_bounds
+from .periods import parse_period
+from . import grid, heatmap, rollups, streaming, tasks, wire
+from .species import catalog
+from datetime import datetime, timezone
+from pydal.objects import Row
+import hmac
 import json
+import math
+import uuid
 
 url_signer = URLSigner(session)
 
 
-# Return a db query that includes only the given partial name or species
-def species_search_filter(nameSearch, nameList):
-    if nameList:
-        return db.sighting.common_name.belongs(nameList.split(","))
-    elif nameSearch:
-        return db.sighting.common_name.contains(nameSearch, case_sensitive=False)
-    else:
-        return True
-
-
-# Parse [min_lon, min_lat, max_lon, max_lat] from a string
-def parse_bounds(bounds):
-    try:
-        l = [float(x) for x in bounds.split(",")]
-        return l if len(l) == 4 else None
-    except:
-        return None
-
-
 @action("default")
 @action.uses(db, auth)
 def default():
@@ -76,8 +76,19 @@ def default():
 @action("index")
 @action.uses("index.html", db, auth, url_signer)
 def index():
-    names = [row.name for row in db(db.species).select(db.species.name, orderby=db.species.name)]
-    return dict(speciesList=json.dumps(names))
+    return dict()
+
+# Species names containing q, for the search boxes
+@action("api/species/search")
+@action.uses(*instrumented(species_validator, db))
+def species_search():
+    ids = catalog.search(request.query.get("q", ""))
+    try:
+        limit = max(0, int(request.query.get("limit", len(ids))))
+    except ValueError:
+        limit = len(ids)
+    return dict(species=[catalog.name(species_id) for species_id in ids[:limit]])
+
 
 @action('current_time')
 def current_time():
@@ -94,9 +105,6 @@ def checklist():
     if not auth.current_user:
         redirect(URL("auth/login"))
 
-    # Get species list for checklist dropdown
-    species = [row.name for row in db(db.species).select(db.species.name, orderby=db.species.name)]
-
     # Latitude and longitude passed as query params
     lat = request.query.get("lat", None)
     lng = request.query.get("lng", None)
@@ -107,53 +115,143 @@ def checklist():
         checklist_data = db(db.checklist.id == edit_id).select().first()  # Fetch checklist data for editing
 
     return dict(
-        speciesList=json.dumps(species),  # Pass species list as JSON
         lat=lat,
         lng=lng,
         checklist_data=checklist_data,  # Pass checklist data for editing
     )
 
 @action("checklist/submit", method=["POST"])
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user))
 def submit_checklist():
     """Handle checklist submissions."""
     user_id = auth.current_user.get("id")
     data = request.json
 
+    changes = []
+    try:
+        checklist_id = save_checklists(user_id, [data], changes)[0]
+        db.commit()  # Ensure data is committed to the database
+        after_write(changes)
+
+        # After saving, redirect to the my_checklist page to see the submitted checklists
+        return dict(success=True, id=checklist_id)
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error submitting checklist: {e}")
+        return dict(success=False, error=str(e))
+
+
+@action("checklist/submit_batch", method=["POST"])
+@action.uses(*instrumented(db, auth.user))
+def submit_checklist_batch():
+    """Store many checklists at once, for clients syncing after being offline.
+    Either all of them are saved, or none."""
+    user_id = auth.current_user.get("id")
+    checklists = (request.json or {}).get("checklists", [])
+    if len(checklists) > MAX_BATCH_CHECKLISTS:
+        return dict(
+            success=False, error="At most %d checklists" % MAX_BATCH_CHECKLISTS
+        )
+
+    changes = []
     try:
+        ids = save_checklists(user_id, checklists, changes)
+        db.commit()
+        after_write(changes)
+        return dict(success=True, ids=ids)
+
+    except Exception as e:
+        db.rollback()
+        logger.error(f"Error submitting checklists: {e}")
+        return dict(success=False, error=str(e))
+
+
+MAX_BATCH_CHECKLISTS = 500
+
+
+# Insert or replace checklists without committing; returns their ids.
+# Every checklist is appended to changes, as are the ones it replaced, as
+# (checklist, sightings, sign) like rollups.update takes them.
+def save_checklists(user_id, checklists, changes):
+    sightings = []  # (event_id, species_id, count)
+    ids = []
+    for data in checklists:
         # Delete previous checklist, if editing
         edit_id = data.get("editId", None)
         if edit_id != None:
-            num_deleted = db((db.checklist.id == edit_id) & (db.checklist.observer_id == user_id)).delete()
-            if num_deleted > 0:
-                db(db.sighting.event_id == edit_id).delete()
-
-        # Insert a new checklist into the database
-        checklist_id = db.checklist.insert(
-            latitude=data.get("lat"),
-            longitude=data.get("lng"),
-            date=datetime.utcnow(),
+            query = (db.checklist.id == edit_id) & (db.checklist.observer_id == user_id)
+            old = db(query).select().first()
+            if old:
+                old_sightings = db(db.sighting.event_id == old.event_id)
+                change = (old, old_sightings.select(), -1)
+                rollups.update(*change)
+                db(query).delete()
+                old_sightings.delete()
+                changes.append(change)
+
+        lat, lng = data.get("lat"), data.get("lng")
+        if lat is None or lng is None:
+            raise ValueError("Missing latitude or longitude")
+        date = data.get("date")
+        checklist = Row(
+            event_id=uuid.uuid4().hex,
+            latitude=float(lat),
+            longitude=float(lng),
+            date=parse_date(date) if date else datetime.utcnow(),
             observer_id=user_id,
             duration_minutes=data.get("duration", 60), # default to 60 if no duration given
         )
-        db(db.checklist.id == checklist_id).update(event_id=checklist_id)
+        checklist.id = db.checklist.insert(**checklist)
 
-        # Insert species counts into the sightings table
+        # Species counts, inserted together below
+        counts = []
         for species_data in data.get("species", []):
-            db.sighting.insert(
-                event_id=checklist_id,
-                common_name=species_data["name"],
-                count=species_data["count"],
-            )
-
-        db.commit()  # Ensure data is committed to the database
-
-        # After saving, redirect to the my_checklist page to see the submitted checklists
-        return dict(success=True)
+            species_id = catalog.id(species_data["name"])
+            if species_id is None:
+                raise ValueError("Unknown species: %s" % species_data["name"])
+            count = int(species_data["count"])
+            counts.append(Row(species_id=species_id, count=count))
+            sightings.append((checklist.event_id, species_id, count))
+
+        rollups.update(checklist, counts)
+        changes.append((checklist, counts, 1))
+        ids.append(checklist.id)
+
+    insert_rows("sighting", ["event_id", "species_id", "count"], sightings)
+    return ids
+
+
+# Naive UTC datetime of an ISO 8601 date, like the stored ones; dates with an
+# offset are converted
+def parse_date(value):
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+# Bring the in-memory data up to date once changes, as filled by
+# save_checklists, are committed. The write stands whatever happens here.
+def after_write(changes):
+    # The column store bumps the generation once it holds the changes, so
+    # results cached after the bump can come from it
+    try:
+        if column_store:
+            generation = column_store.update(changes, result_cache.bump)
+        else:
+            generation = result_cache.bump()
+    except Exception:
+        # A bump the column store didn't make leaves it stale, so it reloads
+        logger.exception("Updating the column store after a write")
+        generation = result_cache.bump()
+    tile_cache.invalidate(
+        [(checklist.latitude, checklist.longitude) for checklist, _, _ in changes],
+        generation,
+    )
+    if settings.WARM_TILES:
+        tasks.warm_tiles.delay()
 
-    except Exception as e:
-        logger.error(f"Error submitting checklist: {e}")
-        return dict(success=False, error=str(e))
 
 @action("my_checklists")
 @action.uses("my_checklists.html", db, auth.user, url_signer)
@@ -165,24 +263,47 @@ def my_checklists():
     
 
 @action("api/get_checklists")
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user))
 def get_checklists():
-    """Display the checklists submitted by the current user."""
+    """Return a page of the checklists submitted by the current user, newest first."""
     user_id = auth.current_user.get("id")
     edit_id = request.query.get("edit_id", None)
+    after_id = request.query.get("after_id", None)
+    try:
+        limit = min(max(int(request.query.get("limit", 20)), 1), 100)
+    except ValueError:
+        return dict(error="Invalid limit")
 
     # Fetch the checklists submitted by the user
     query = db.checklist.observer_id == user_id
     if edit_id != None:
         query &= db.checklist.id == edit_id
-    checklists = db(query).select()
+    if after_id != None:
+        # Continue right after the last checklist of the previous page
+        last = db(query & (db.checklist.id == after_id)).select().first()
+        if last is None:
+            return dict(error="Invalid after_id")
+        query &= (db.checklist.date < last.date) | (
+            (db.checklist.date == last.date) & (db.checklist.id < last.id)
+        )
+    checklists = db(query).select(
+        orderby=~db.checklist.date | ~db.checklist.id, limitby=(0, limit + 1)
+    )
+    has_more = len(checklists) > limit
+    checklists = checklists[:limit]
+
+    # Fetch the species counts of the whole page at once
+    species_counts = {}
+    sightings = db(
+        db.sighting.event_id.belongs([checklist.event_id for checklist in checklists])
+    ).select(orderby=db.sighting.id)
+    for species in sightings:
+        species_counts.setdefault(species.event_id, []).append(
+            {"name": catalog.name(species.species_id), "count": species.count}
+        )
 
     checklists_data = []
     for checklist in checklists:
-        # Fetch the species count for each checklist (if needed)
-        species_counts = db(db.sighting.event_id == checklist.id).select()
-        species_data = [{"name": species.common_name, "count": species.count} for species in species_counts]
-
         # Add data to the checklist info
         checklists_data.append({
             "id": checklist.id,
@@ -191,25 +312,36 @@ def get_checklists():
             "latitude": checklist.latitude,
             "longitude": checklist.longitude,
             "duration": checklist.duration_minutes,
-            "species": species_data,
+            "species": species_counts.get(checklist.event_id, []),
         })
 
-    return dict(checklists=checklists_data)
+    return dict(
+        checklists=checklists_data,
+        next_after_id=checklists.last().id if has_more else None,
+    )
 
 @action("my_checklist/delete/<checklist_id:int>", method="DELETE")
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user))
 def delete_checklist(checklist_id):
     """Delete a specific checklist owned by the user."""
     user_id = auth.current_user.get("id")
     
     # Delete the checklist itself
-    num_deleted = db((db.checklist.id == checklist_id) & (db.checklist.observer_id == user_id)).delete()
+    query = (db.checklist.id == checklist_id) & (db.checklist.observer_id == user_id)
+    checklist = db(query).select().first()
+    if checklist is None:
+        return dict(success=False)
+    db(query).delete()
 
     # Delete the sightings related to this checklist
-    if num_deleted > 0:
-        db(db.sighting.id == checklist_id).delete()
-    
-    return dict(success=num_deleted>0)
+    sightings = db(db.sighting.event_id == checklist.event_id)
+    change = (checklist, sightings.select(), -1)
+    rollups.update(*change)
+    sightings.delete()
+    db.commit()
+    after_write([change])
+
+    return dict(success=True)
     
 
 @action("location")
@@ -223,31 +355,48 @@ def index():
 
 
 @action("api/species_by_region")
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user, region_validator))
 def species_by_region():
     bounds = parse_bounds(request.params.get("bounds"))
     if not bounds:
         return dict(error="Missing or invalid bounds")
+    try:
+        period = parse_period(request.params)
+    except ValueError:
+        return dict(error="Invalid period")
 
-    total_count = db.sighting.count.sum()
-    species_data = db(
-        (db.sighting.event_id == db.checklist.event_id)
-        & (db.checklist.longitude > bounds[0])
-        & (db.checklist.latitude > bounds[1])
-        & (db.checklist.longitude < bounds[2])
-        & (db.checklist.latitude < bounds[3])
-    ).select(db.sighting.common_name, total_count, groupby=db.sighting.common_name)
+    species = sorted(
+        (catalog.name(species_id), total)
+        for species_id, total in species_totals(bounds, period)
+    )
+    # The species are all listed, so their number is exact, unlike the
+    # estimates of api/sightings?mode=richness
+    if wire.wants_packed():
+        response.headers["X-Richness"] = str(len(species))
+        return wire.reply(wire.pack_species(species))
 
-    # Format the result as an array of objects
+    # Format the result as an array of objects, sorted by name
     formatted_data = [
-        {"common_name": row.sighting.common_name, "total_count": row[total_count]}
-        for row in species_data
+        {"common_name": name, "total_count": total} for name, total in species
     ]
-    return dict(data=formatted_data)
+    return dict(data=formatted_data, richness=len(species))
+
+
+# List of (species_id, total count) for the species seen inside the bounds,
+# during the periods.Period if given
+@columnar
+def species_totals(bounds, period=None):
+    total_count = db.sighting.count.sum()
+    rows = db(
+        (db.sighting.event_id == db.checklist.event_id)
+        & checklist_in_bounds(bounds)
+        & in_period(db.checklist.date, period)
+    ).select(db.sighting.species_id, total_count, groupby=db.sighting.species_id)
+    return [(row.sighting.species_id, row[total_count]) for row in rows]
 
 
 @action("api/species_trends")
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user, region_validator))
 def species_trends():
     species_name = request.params.get("species_name")
     if not species_name:
@@ -257,25 +406,22 @@ def species_trends():
     if not bounds:
         return dict(error="Missing or invalid bounds")
 
+    granularity = request.params.get("granularity", "day")
+    if granularity not in rollups.GRANULARITIES:
+        return dict(error="Invalid granularity")
     try:
-        total_count = db.sighting.count.sum()
-        trends = db(
-            (db.sighting.event_id == db.checklist.event_id)
-            & (db.sighting.common_name == species_name)
-            & (db.checklist.longitude > bounds[0])
-            & (db.checklist.latitude > bounds[1])
-            & (db.checklist.longitude < bounds[2])
-            & (db.checklist.latitude < bounds[3])
-        ).select(
-            db.checklist.date,
-            total_count,
-            groupby=db.checklist.date,
-            orderby=db.checklist.date,
-        )
+        period = parse_period(request.params)
+    except ValueError:
+        return dict(error="Invalid period")
 
+    try:
+        species_id = catalog.id(species_name)
+        if species_id is None:
+            return dict(data=[])
+        trends = rollups.species_trend(species_id, bounds, granularity, period)
         formatted_trends = [
-            {"date": row.checklist.date, "total_count": row[total_count]}
-            for row in trends
+            {"date": date, "total_count": total_count}
+            for date, total_count in trends
         ]
         return dict(data=formatted_trends)
     except Exception as e:
@@ -284,57 +430,29 @@ def species_trends():
 
 
 @action("api/top_contributors")
-@action.uses(db, auth.user)
+@action.uses(*instrumented(db, auth.user, region_validator))
 def top_contributors():
     bounds = parse_bounds(request.params.get("bounds"))
     if not bounds:
         return dict(error="Missing or invalid bounds")
-
-    checklist_count = db.checklist.id.count()
-    contributors = db(
-        (db.checklist.longitude > bounds[0])
-        & (db.checklist.latitude > bounds[1])
-        & (db.checklist.longitude < bounds[2])
-        & (db.checklist.latitude < bounds[3])
-    ).select(
-        db.checklist.observer_id,
-        checklist_count,
-        groupby=db.checklist.observer_id,
-        orderby=~checklist_count,
-        limitby=(0, 5),
-    )
+    try:
+        period = parse_period(request.params)
+    except ValueError:
+        return dict(error="Invalid period")
 
     # Format the result as an array of objects
     formatted_contributors = [
-        {
-            "observer_id": row.checklist.observer_id,
-            "checklist_count": row[checklist_count],
-        }
-        for row in contributors
+        {"observer_id": observer_id, "checklist_count": checklist_count}
+        for observer_id, checklist_count in rollups.top_contributors(bounds, period)
     ]
     return dict(data=formatted_contributors)
 
 
 @action("statistics")
-@action.uses("statistics.html", db, auth, url_signer)
+@action.uses(*instrumented("statistics.html", db, auth, url_signer))
 def statistics():
     if not auth.current_user:
         redirect(URL("index"))
-    # Get list of all sightings by the user
-    events = (
-        db(db.checklist.observer_id == auth.current_user.get("id"))
-        .select()
-        .sort(lambda row: row.date)
-        .as_list()
-    )
-
-    # Sightings by day
-    sightingsByDay = {}
-    for event in events:
-        date = event["date"].date()
-        if date not in sightingsByDay:
-            sightingsByDay[date] = 0
-        sightingsByDay[date] += 1
 
     searchForm = Form(
         [
@@ -347,78 +465,249 @@ def statistics():
     if searchForm.accepted:
         searchTerm = searchForm.vars.get("Search")
 
-    # Species Seen, When, Where
-    speciesSeen = {}
-    for event in events:
-        event_id = event["event_id"]
-        date = event["date"].date()
-        if searchTerm != "":
-            species = (
-                db(
-                    (db.sighting.event_id == event_id)
-                    & (db.sighting.common_name.contains(searchTerm))
-                )
-                .select()
-                .first()
-            )
-        else:
-            species = db(db.sighting.event_id == event_id).select().first()
-        if species == None:
-            continue
-        if species.common_name not in speciesSeen:
-            speciesSeen[species.common_name] = []
-        speciesSeen[species.common_name].append(
-            (date, (event["latitude"], event["longitude"]))
-        )
-
-    # Time spent bird watching by day
-    timeByDay = {}
-    for event in events:
-        date = event["date"].date()
-        if date not in timeByDay:
-            timeByDay[date] = 0
-        timeByDay[date] += event["duration_minutes"]
-
-    timeByMonth = {}
-    for event in events:
-        date = event["date"].date().month
-        if date not in timeByMonth:
-            timeByMonth[date] = 0
-        timeByMonth[date] += event["duration_minutes"]
+    # Per day, per month and per species aggregates of the user's checklists
+    stats = user_statistics(db, auth.current_user.get("id"), searchTerm)
 
     return dict(
         # COMPLETE: return here any signed URLs you need.
-        sightingsByDay=sightingsByDay,
-        timeByDay=timeByDay,
-        timeByMonth=timeByMonth,
-        speciesSeen=speciesSeen,
         searchForm=searchForm,
         my_callback_url=URL("my_callback", signer=url_signer),
+        **stats,
     )
 
 
 @action("api/sightings")
-@action.uses(db)
+@action.uses(*instrumented(map_validator, db))
 def get_sightings():
     # Get filters
-    filter = species_search_filter(
+    species_ids = species_search_ids(
         request.query.get("search"), request.query.get("list")
     )
+    try:
+        period = parse_period(request.query)
+    except ValueError:
+        return dict(error="Invalid period")
+
+    # With a viewport, serve pre-binned cells instead of every checklist
+    bounds = parse_bounds(request.query.get("bounds"))
+    try:
+        size = parse_cell_size(request.query.get("zoom"), request.query.get("cell"))
+    except ValueError:
+        response.status = 400
+        return dict(error="Invalid cell size")
+    mode = request.query.get("mode", "count")
+    if mode == "richness":
+        return richness_sightings(species_ids, bounds, size, period)
+    if mode != "count":
+        return dict(error="Invalid mode")
+    if bounds and size:
+        return grid_sightings(species_ids, bounds, size, period)
+
+    key = ("sightings", species_ids, period)
+    if wire.wants_packed():
+        result = result_cache.get(key, lambda: all_sightings(species_ids, period))
+        # Packed once per result, like the result itself
+        return wire.reply(
+            result_cache.get(
+                key + ("packed",), lambda: wire.pack_sightings(result)
+            )
+        )
+
+    # The whole map is large: it is written out as it is read, and cached
+    result = result_cache.peek(key)
+    if result is None and not (column_store and column_store.current()):
+        rows = streaming.query_rows(db, lambda: iter_sightings(species_ids, period))
+        return streaming.json_object("sightings", result_cache.filling(key, rows))
+    if result is None:
+        result = result_cache.get(key, lambda: all_sightings(species_ids, period))
+    return streaming.json_object("sightings", result)
+
+
+# List of [lat, lng, count] for every checklist with the species, during the
+# periods.Period if given
+@columnar
+def all_sightings(species_ids, period=None):
+    return list(iter_sightings(species_ids, period))
+
 
-    # Get all sightings and their coordinates
+# The same, one row at a time from the cursor
+def iter_sightings(species_ids, period=None):
     totalSightings = db.sighting.count.sum()
-    rows = db((db.sighting.event_id == db.checklist.event_id) & filter).select(
+    rows = db(
+        (db.sighting.event_id == db.checklist.event_id)
+        & species_search_filter(species_ids)
+        & in_period(db.checklist.date, period)
+    ).iterselect(
         db.checklist.latitude,
         db.checklist.longitude,
         totalSightings,
         groupby=db.sighting.event_id,
-        cache=(cache.get, 300),
-        cacheable=True,
     )
+    for row in rows:
+        yield [row.checklist.latitude, row.checklist.longitude, row[totalSightings]]
+
+
+# Parse the grid cell size, in degrees, from a zoom level or an explicit size,
+# or None without either. Sizes are clamped to the cells of the deepest zoom,
+# so that a box never holds more cells than a screen at that zoom would.
+# Raises ValueError for an invalid value.
+def parse_cell_size(zoom, cell):
+    if cell:
+        size = float(cell)
+        if not math.isfinite(size) or size <= 0:
+            raise ValueError("Invalid cell size: %s" % cell)
+        return max(size, grid.cell_size(grid.MAX_ZOOM))
+    if zoom:
+        return grid.cell_size(zoom)
+    return None
+
+
+# Sum sightings per grid cell inside the bounds
+def grid_sightings(species_ids, bounds, size, period=None):
+    # Snap to whole cells so that panning reuses the same cells and cache keys
+    bounds = grid.snap_bounds(bounds, size)
+    result = result_cache.get(
+        ("grid", species_ids, tuple(bounds), size, period),
+        lambda: grid_cells(species_ids, bounds, size, period),
+    )
+    counts = [cell[2] for cell in result]
+    grid_data = dict(
+        bounds=bounds,
+        cell=size,
+        max=max(counts, default=None),
+        median=grid.median(counts),
+    )
+    if wire.wants_packed():
+        # The other fields travel in a header, as JSON
+        response.headers["X-Grid"] = json.dumps(grid_data)
+        return wire.reply(wire.pack_sightings(result))
+    return dict(sightings=result, **grid_data)
+
+
+# Estimated number of species per grid cell inside the bounds, or the whole
+# map, and in all of them, see rollups.richness_cells
+def richness_sightings(species_ids, bounds, size, period=None):
+    # Cells are made of rollup cells, so they can't be finer
+    size = max(size or rollups.SIZE, rollups.SIZE)
+    bounds = grid.snap_bounds(bounds or [-180, -90, 180, 90], size)
+    result, richness = result_cache.get(
+        ("richness", species_ids, tuple(bounds), size, period),
+        lambda: rollups.richness_cells(species_ids, bounds, size, period),
+    )
+    counts = [cell[2] for cell in result]
+    grid_data = dict(
+        bounds=bounds,
+        cell=size,
+        richness=richness,
+        max=max(counts, default=None),
+        median=grid.median(counts),
+    )
+    if wire.wants_packed():
+        response.headers["X-Grid"] = json.dumps(grid_data)
+        return wire.reply(wire.pack_sightings(result))
+    return dict(sightings=result, **grid_data)
+
+
+@action("api/sightings/tiles/<z:int>/<x:int>/<y:int>")
+@action.uses(*instrumented(map_validator, db))
+def get_sighting_tile(z, x, y):
+    if not (0 <= z <= grid.MAX_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z):
+        return dict(error="Invalid tile")
+
+    species_ids = species_search_ids(
+        request.query.get("search"), request.query.get("list")
+    )
+    try:
+        period = parse_period(request.query)
+    except ValueError:
+        return dict(error="Invalid period")
+    cells = heatmap.tile(z, x, y, species_ids, period)
+    if wire.wants_packed():
+        return wire.reply(wire.pack_sightings(cells))
+    return dict(sightings=cells)
+
+
+# Cells of the map for each week of the year, for an animation of the
+# migrations, over the whole map without bounds
+@action("api/sightings/weekly")
+@action.uses(*instrumented(map_validator, db))
+def get_weekly_sightings():
+    species_ids = species_search_ids(
+        request.query.get("search"), request.query.get("list")
+    )
+    try:
+        period = parse_period(request.query)
+    except ValueError:
+        return dict(error="Invalid period")
+    bounds = parse_bounds(request.query.get("bounds")) or [-180, -90, 180, 90]
+    try:
+        size = parse_cell_size(request.query.get("zoom"), request.query.get("cell"))
+    except ValueError:
+        response.status = 400
+        return dict(error="Invalid cell size")
+    # Frames are made of rollup cells, so they can't be finer
+    size = max(size or rollups.SIZE, rollups.SIZE)
+    bounds = grid.snap_bounds(bounds, size)
+    frames = result_cache.get(
+        ("weekly", species_ids, tuple(bounds), size, period),
+        lambda: rollups.weekly_frames(species_ids, bounds, size, period),
+    )
+    return dict(
+        bounds=bounds,
+        cell=size,
+        max=max((cell[2] for frame in frames for cell in frame), default=None),
+        frames=frames,
+    )
+
+
+# Clusters of checklists for the viewport, from the rollup of each zoom, so
+# that the map never loads every checklist
+@action("api/sightings/clusters")
+@action.uses(*instrumented(map_validator, db))
+def get_sighting_clusters():
+    bounds = parse_bounds(request.query.get("bounds"))
+    try:
+        zoom = min(max(int(request.query.get("zoom")), 0), grid.CLUSTER_MAX_ZOOM)
+    except (TypeError, ValueError):
+        zoom = None
+    if not bounds or zoom is None:
+        return dict(error="Invalid bounds or zoom")
+    bounds = grid.snap_bounds(bounds, grid.cell_size(zoom))
+    clusters = result_cache.get(
+        ("clusters", tuple(bounds), zoom), lambda: rollups.clusters(bounds, zoom)
+    )
+    return dict(
+        bounds=bounds,
+        zoom=zoom,
+        max=max((cluster[3] for cluster in clusters), default=None),
+        median=grid.median([cluster[3] for cluster in clusters]),
+        clusters=clusters,
+    )
+
 
-    # Serve list of [lat, lng, count]
-    result = [
-        [row.checklist.latitude, row.checklist.longitude, row[totalSightings]]
-        for row in rows
+# Request timings and cache statistics in the Prometheus text format, for a
+# scraper sending "Authorization: Bearer <METRICS_TOKEN>". Behind a reverse
+# proxy every request comes from the loopback, so the peer address can't tell.
+@action("api/_metrics")
+def metrics():
+    expected = "Bearer %s" % settings.METRICS_TOKEN
+    given = request.headers.get("Authorization", "")
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(
+        given.encode(), expected.encode()
+    ):
+        abort(403)
+    stats = result_cache.stats()
+    lines = [
+        "# TYPE app_result_cache_requests_total counter",
+        'app_result_cache_requests_total{result="hit"} %d' % stats["hits"],
+        'app_result_cache_requests_total{result="stale"} %d' % stats["stale_hits"],
+        'app_result_cache_requests_total{result="miss"} %d' % stats["misses"],
+        "# TYPE app_result_cache_entries gauge",
+        "app_result_cache_entries %d" % stats["entries"],
+        "# TYPE app_data_generation gauge",
+        "app_data_generation %d" % stats["generation"],
+        "# TYPE app_tile_cache_entries gauge",
+        "app_tile_cache_entries %d" % len(tile_cache.tiles),
     ]
-    return dict(sightings=result)
+    response.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return instrumentation.metrics.render() + "\n".join(lines) + "\n"
@@ -0,0 +1,91 @@
+"""
+This file defines the fixed-degree grid used to aggregate sightings for the maps.
+Cells are indexed from (-90, -180) so that the indexes are never negative, which
+lets the database compute them with a plain integer cast.
+"""
+
+import math
+
+TILE_SIZE = 256  # Leaflet tile size in pixels
+CELL_PIXELS = 16  # Target on-screen size of one aggregation cell
+MAX_ZOOM = 18
+CLUSTER_MAX_ZOOM = 16  # Deepest zoom of the checklist clusters, cells of about 30m
+MAX_LATITUDE = 85.0511287798  # Web mercator tiles stop here
+BOUNDS_DIGITS = 6  # Decimals kept from query bounds, about 10 cm
+
+
+# Size in degrees of a cell that spans about CELL_PIXELS pixels at this zoom
+def cell_size(zoom):
+    zoom = min(max(int(zoom), 0), MAX_ZOOM)
+    return 360.0 * CELL_PIXELS / (TILE_SIZE * 2**zoom)
+
+
+# Index of the cell containing the given latitude and longitude
+def cell_index(lat, lng, size):
+    return int((lat + 90) / size), int((lng + 180) / size)
+
+
+# Parse [min_lon, min_lat, max_lon, max_lat] from a string, rounded to
+# BOUNDS_DIGITS decimals so that nearly equal bounds are the same request
+def parse_bounds(bounds):
+    try:
+        l = [round(float(x), BOUNDS_DIGITS) for x in bounds.split(",")]
+        return l if len(l) == 4 else None
+    except:
+        return None
+
+
+# Clip [min_lon, min_lat, max_lon, max_lat] to the valid coordinate range
+def clip_bounds(bounds):
+    return [
+        min(max(bounds[0], -180.0), 180.0),
+        min(max(bounds[1], -90.0), 90.0),
+        min(max(bounds[2], -180.0), 180.0),
+        min(max(bounds[3], -90.0), 90.0),
+    ]
+
+
+# Expand [min_lon, min_lat, max_lon, max_lat] outward to whole cells
+def snap_bounds(bounds, size):
+    bounds = clip_bounds(bounds)
+    min_lat, min_lng = cell_index(bounds[1], bounds[0], size)
+    max_lat, max_lng = cell_index(bounds[3], bounds[2], size)
+    return [
+        max(min_lng * size - 180, -180.0),
+        max(min_lat * size - 90, -90.0),
+        min((max_lng + 1) * size - 180, 180.0),
+        min((max_lat + 1) * size - 90, 90.0),
+    ]
+
+
+# Median of a list of numbers, or None when empty
+def median(values):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+# Bounds [min_lon, min_lat, max_lon, max_lat] of a web mercator tile
+def tile_bounds(z, x, y):
+    n = 2**z
+    return [
+        x / n * 360.0 - 180,
+        _tile_lat(y + 1, n),
+        (x + 1) / n * 360.0 - 180,
+        _tile_lat(y, n),
+    ]
+
+
+# Tile (x, y) containing the given latitude and longitude at zoom z
+def tile_index(lat, lng, z):
+    n = 2**z
+    lat = math.radians(min(max(lat, -MAX_LATITUDE), MAX_LATITUDE))
+    x = int((lng + 180) / 360.0 * n)
+    # Tiles are numbered southward and include their southern edge
+    y = math.ceil((1 - math.asinh(math.tan(lat)) / math.pi) / 2 * n) - 1
+    return min(x, n - 1), min(max(y, 0), n - 1)
+
+
+def _tile_lat(y, n):
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
@@ -0,0 +1,54 @@
+"""
+This file holds the queries behind the heatmap: sightings summed per grid cell,
+and the map tiles made of them, cached in common.tile_cache.
+"""
+
+from .common import db, tile_cache, columnar
+from .models import checklist_cells, checklist_in_bounds, in_period
+from .species import catalog
+from . import grid
+
+
+# Sorted ids of the species matching the given partial name or species list,
+# or None when there is no filter. Searches that match the same species share it.
+def species_search_ids(nameSearch, nameList):
+    if nameList:
+        return tuple(sorted(catalog.ids(nameList.split(","))))
+    elif nameSearch:
+        return tuple(sorted(catalog.search(nameSearch)))
+    else:
+        return None
+
+
+# Return a db query that includes only the given species ids
+def species_search_filter(species_ids):
+    if species_ids is None:
+        return True
+    return db.sighting.species_id.belongs(species_ids)
+
+
+# List of [lat, lng, count] for every non-empty cell, clipped to the bounds,
+# counting the checklists of the periods.Period if given
+@columnar
+def grid_cells(species_ids, bounds, size, period=None):
+    lat_cell, lng_cell = checklist_cells(size)
+    lat = db.checklist.latitude.avg()
+    lng = db.checklist.longitude.avg()
+    totalSightings = db.sighting.count.sum()
+    rows = db(
+        (db.sighting.event_id == db.checklist.event_id)
+        & checklist_in_bounds(bounds, half_open=True)
+        & species_search_filter(species_ids)
+        & in_period(db.checklist.date, period)
+    ).select(lat, lng, totalSightings, groupby=lat_cell | lng_cell)
+    return [[row[lat], row[lng], row[totalSightings]] for row in rows]
+
+
+# Cells of tile z/x/y for the species and period, computed once and then cached
+def tile(z, x, y, species_ids=None, period=None):
+    return tile_cache.get(
+        (z, x, y, (species_ids, period)),
+        lambda: grid_cells(
+            species_ids, grid.tile_bounds(z, x, y), grid.cell_size(z), period
+        ),
+    )
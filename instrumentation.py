@@ -0,0 +1,229 @@
+"""
+This file defines an opt-in fixture that times requests, phase by phase, and
+records the SQL statements they run. Slow statements are logged with their
+query plan, and the timings are served by api/_metrics as Prometheus text.
+With a query log, the queries are also appended to it, one JSON object per
+line, for benchmarks/index_advisor.py.
+
+    @action.uses(*instrumented(db, auth.user))  # see common.py
+
+The phases of a request are:
+- sql: statements run by the action
+- python: the rest of the action
+- fixtures: other fixtures before and after the action, including their SQL
+  (sessions, auth, commits) and template rendering
+- serialize: turning a dict returned by the action into JSON
+"""
+
+import json
+import threading
+import time
+from py4web import request, response
+from py4web.core import Fixture, dumps
+from pydal.helpers.classes import ExecutionHandler
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Histograms and counters keyed by metric name and label values"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (name, labels) -> Histogram
+        self.counters = {}  # (name, labels) -> count
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def increment(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            counters = sorted(self.counters.items())
+        for name in sorted({name for (name, _), _ in histograms}):
+            lines.append("# TYPE %s histogram" % name)
+            for (metric, labels), histogram in histograms:
+                if metric != name:
+                    continue
+                buckets = list(zip(BUCKETS, histogram.counts))
+                buckets.append(("+Inf", histogram.count))
+                for bound, count in buckets:
+                    bucket_labels = format_labels(labels + (("le", bound),))
+                    lines.append("%s_bucket%s %d" % (name, bucket_labels, count))
+                labels = format_labels(labels)
+                lines.append("%s_sum%s %f" % (name, labels, histogram.sum))
+                lines.append("%s_count%s %d" % (name, labels, histogram.count))
+        for name in sorted({name for (name, _), _ in counters}):
+            lines.append("# TYPE %s counter" % name)
+            for (metric, labels), count in counters:
+                if metric == name:
+                    lines.append("%s%s %d" % (name, format_labels(labels), count))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (key, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for key, value in labels
+    )
+
+
+class QueryRecorder(ExecutionHandler):
+    """Reports the duration of every statement to the instrumentation"""
+
+    def __init__(self, adapter, instrumentation):
+        super().__init__(adapter)
+        self.instrumentation = instrumentation
+
+    def before_execute(self, command):
+        self.start = time.perf_counter()
+
+    def after_execute(self, command):
+        self.instrumentation.record_query(
+            self.adapter, command, time.perf_counter() - self.start
+        )
+
+
+class ActionMarker(Fixture):
+    """Innermost fixture, marks when the action itself starts and ends"""
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+    def on_request(self, context):
+        self.instrumentation.mark("action_start")
+
+    def on_success(self, context):
+        self.instrumentation.mark("action_end")
+
+    def on_error(self, context):
+        self.instrumentation.mark("action_end")
+
+
+class Instrumentation(Fixture):
+    def __init__(self, db, logger, slow_query=0.25, query_log=None):
+        self.db = db
+        self.logger = logger
+        self.slow_query = slow_query
+        self.query_log = query_log  # path of the query log, or None
+        self.metrics = Metrics()
+        self.action = ActionMarker(self)
+        db._adapter.execution_handlers.append(
+            lambda adapter: QueryRecorder(adapter, self)
+        )
+
+    def on_request(self, context):
+        Fixture.local_initialize(self)
+        self.local.start = time.perf_counter()
+        self.local.action_start = self.local.action_end = None
+        self.local.fixture_sql = 0.0
+        self.local.action_sql = 0.0
+
+    def mark(self, name):
+        if self.is_valid():
+            setattr(self.local, name, time.perf_counter())
+
+    def on_success(self, context):
+        # Serialize here, rather than in py4web, to time it
+        start = time.perf_counter()
+        if isinstance(context["output"], (dict, list)):
+            response.headers.setdefault("Content-Type", "application/json")
+            context["output"] = dumps(context["output"])
+        end = time.perf_counter()
+        self.observe(end, serialize=end - start)
+
+    def on_error(self, context):
+        self.metrics.increment("app_request_errors_total", dict(action=action_name()))
+        self.observe(time.perf_counter())
+
+    def observe(self, end, serialize=0.0):
+        local = self.local
+        action = action_name()
+        phases = dict(total=end - local.start, serialize=serialize)
+        if local.action_start is not None and local.action_end is not None:
+            run = local.action_end - local.action_start
+            phases["sql"] = local.action_sql
+            phases["python"] = max(0.0, run - local.action_sql)
+            phases["fixtures"] = max(0.0, phases["total"] - run - serialize)
+        else:
+            # Without the marker, fixtures can't be told apart from the action
+            phases["sql"] = local.action_sql + local.fixture_sql
+            phases["python"] = max(0.0, phases["total"] - phases["sql"] - serialize)
+        for phase, seconds in phases.items():
+            self.metrics.observe(
+                "app_request_seconds", dict(action=action, phase=phase), seconds
+            )
+
+    def record_query(self, adapter, command, seconds):
+        if not self.is_valid():
+            return
+        local = self.local
+        if local.action_start is not None and local.action_end is None:
+            local.action_sql += seconds
+        else:
+            local.fixture_sql += seconds
+        action = action_name()
+        self.metrics.observe("app_sql_seconds", dict(action=action), seconds)
+        if seconds >= self.slow_query:
+            self.metrics.increment("app_slow_queries_total", dict(action=action))
+            self.log_slow_query(adapter, command, seconds, action)
+        if self.query_log and command.lstrip().upper().startswith(("SELECT", "WITH")):
+            line = json.dumps(dict(action=action, seconds=seconds, sql=command))
+            # One write per line, so lines of concurrent requests don't mix
+            with open(self.query_log, "a") as log:
+                log.write(line + "\n")
+
+    def log_slow_query(self, adapter, command, seconds, action):
+        plan = ""
+        if command.lstrip().upper().startswith(("SELECT", "WITH")):
+            explain = "EXPLAIN QUERY PLAN " if adapter.dbengine == "sqlite" else "EXPLAIN "
+            try:
+                # A new cursor, so the rows of the slow query stay readable
+                cursor = adapter.connection.cursor()
+                cursor.execute(explain + command)
+                plan = "\n".join(" ".join(map(str, row)) for row in cursor.fetchall())
+            except Exception as error:
+                plan = "(no plan: %s)" % error
+        self.logger.warning(
+            "Slow query in %s, %.3fs: %s\n%s" % (action, seconds, command, plan)
+        )
+
+
+# Route of the current request, without the app name
+def action_name():
+    try:
+        # ombott gives the route's method, bottle the route itself
+        route = request.route
+        rule = getattr(route, "rule", None) or route.route.rule
+    except Exception:
+        rule = request.path
+    prefix = "/%s/" % request.app_name
+    return rule[len(prefix) :] if rule.startswith(prefix) else rule
@@ -3,9 +3,10 @@ This file defines the database models
 """
 
 import datetime
-import csv
+from . import settings
 from .common import db, Field, auth, logger
 from pydal.validators import *
+from pydal.objects import Expression
 
 
 def get_user_email():
@@ -16,10 +17,12 @@ def get_time():
     return datetime.datetime.utcnow()
 
 
+db.define_table("species", Field("name", unique=True))
+
 db.define_table(
     "sighting",
     Field("event_id"),
-    Field("common_name"),
+    Field("species_id", "reference species"),
     Field("count", "integer"),
 )
 
@@ -33,48 +36,293 @@ db.define_table(
     Field("duration_minutes", "integer"),
 )
 
-db.define_table("species", Field("name", unique=True))
+# Total birds per species, grid cell and day, maintained by rollups.py
+db.define_table(
+    "species_day",
+    Field("species_id", "reference species"),
+    Field("day", "date"),
+    Field("lat_cell", "integer"),
+    Field("lng_cell", "integer"),
+    Field("total", "integer"),
+)
 
-# Prime databases
-if db(db.sighting).isempty():
-    print("Priming sighting database...")
-    sightings = csv.reader(open("sample_data/sightings.csv"), delimiter=",")
-
-    db.sighting.bulk_insert(
-        [
-            dict(
-                event_id=sighting[0][1:],
-                common_name=sighting[1],
-                count=1 if sighting[2] == "X" else sighting[2],
-            )
-            for sighting in list(sightings)[1:]
-        ]
+# Total birds per species, grid cell and week of the year, over all years,
+# maintained by rollups.py for the weekly frames of api/sightings/weekly
+db.define_table(
+    "species_week",
+    Field("species_id", "reference species"),
+    Field("week", "integer"),
+    Field("lat_cell", "integer"),
+    Field("lng_cell", "integer"),
+    Field("total", "integer"),
+)
+
+# Checklists, their birds and their summed coordinates per zoom level and cell
+# of that zoom's grid, maintained by rollups.py for api/sightings/clusters.
+# Cells halve from one zoom to the next, so each level refines the one above.
+db.define_table(
+    "cluster_cell",
+    Field("zoom", "integer"),
+    Field("lat_cell", "integer"),
+    Field("lng_cell", "integer"),
+    Field("checklists", "integer"),
+    Field("birds", "integer"),
+    Field("lat_sum", "double"),
+    Field("lng_sum", "double"),
+)
+
+# HyperLogLog sketch of the species seen per grid cell, maintained by
+# rollups.py for the species richness of any box, see sketches.py
+db.define_table(
+    "species_sketch",
+    Field("lat_cell", "integer"),
+    Field("lng_cell", "integer"),
+    Field("registers", "text"),
+)
+
+# Checklists per observer and grid cell, maintained by rollups.py
+db.define_table(
+    "observer_cell",
+    Field("observer_id"),
+    Field("lat_cell", "integer"),
+    Field("lng_cell", "integer"),
+    Field("checklists", "integer"),
+)
+
+
+# Replace the common_name column of tables created before species_id existed.
+# SQLite keeps columns that are removed from a model, so the names are still there.
+def migrate_species_names(table, old_indexes=()):
+    try:
+        db.executesql("SELECT common_name FROM %s WHERE 1 = 0;" % table)
+    except Exception:
+        db.rollback()
+        return
+    logger.warning("Moving %s.common_name to species_id" % table)
+    db.executesql(
+        """INSERT INTO species (name)
+        SELECT DISTINCT common_name FROM %s WHERE common_name IS NOT NULL
+        ON CONFLICT DO NOTHING;"""
+        % table
+    )
+    db.executesql(
+        """UPDATE %s SET species_id =
+        (SELECT species.id FROM species WHERE species.name = %s.common_name)
+        WHERE species_id IS NULL;"""
+        % (table, table)
     )
+    for index in old_indexes:
+        db.executesql("DROP INDEX IF EXISTS %s;" % index)
+    db.executesql("ALTER TABLE %s DROP COLUMN common_name;" % table)
+    db.commit()
+
+
+# Secondary indexes, created when missing: name -> (table, columns).
+# benchmarks/index_advisor.py checks the plans of the captured queries.
+INDEXES = {
+    # joins of sightings to their checklist
+    "sighting_event_id": ("sighting", ["event_id"]),
+    "checklist_event_id": ("checklist", ["event_id"]),
+    # species filters of the maps
+    "sighting_species_event": ("sighting", ["species_id", "event_id"]),
+    # a user's checklists and statistics
+    "checklist_observer_date": ("checklist", ["observer_id", "date"]),
+    # date ranges of the maps and regions
+    "checklist_date": ("checklist", ["date"]),
+    # weekly frames, grouped without a temporary B-tree, and those of a period
+    "species_week_frames": ("species_week", ["week", "lat_cell", "lng_cell"]),
+    "species_day_frames": ("species_day", ["day", "lat_cell", "lng_cell"]),
+}
+
+# Unique indexes, also used as ON CONFLICT targets: name -> (table, columns)
+UNIQUE_INDEXES = {
+    "species_day_key": ("species_day", ["species_id", "lat_cell", "lng_cell", "day"]),
+    "observer_cell_key": ("observer_cell", ["lat_cell", "lng_cell", "observer_id"]),
+    "species_week_key": ("species_week", ["species_id", "lat_cell", "lng_cell", "week"]),
+    "cluster_cell_key": ("cluster_cell", ["zoom", "lat_cell", "lng_cell"]),
+    "species_sketch_key": ("species_sketch", ["lat_cell", "lng_cell"]),
+}
+
+# SQLite keeps checklist coordinates in an R*Tree, other backends use a B-tree
+HAS_RTREE = db._adapter.dbengine == "sqlite"
+if not HAS_RTREE:
+    INDEXES["checklist_location"] = ("checklist", ["latitude", "longitude"])
+RTREE_OBJECTS = [
+    "checklist_rtree",
+    "checklist_rtree_insert",
+    "checklist_rtree_update",
+    "checklist_rtree_delete",
+]
+
+# Tables are defined lazily, when first used, so importing the app doesn't
+# read the migration file of each. Migrations alter tables and commit, which
+# must not happen in the middle of a request, so with DB_MIGRATE on every
+# table is still defined, and migrated, here.
+if settings.DB_MIGRATE:
+    for table in db.tables:
+        db[table]
+
+# Indexes are only created when SQLite's catalog lacks them; other engines
+# always check
+if db._adapter.dbengine == "sqlite":
+    schema = dict(db.executesql("SELECT name, sql FROM sqlite_master;"))
+else:
+    schema = None
 
-if db(db.checklist).isempty():
-    print("Priming checklist database...")
-    checklist = csv.reader(open("sample_data/checklists.csv"), delimiter=",")
-
-    db.checklist.bulk_insert(
-        [
-            dict(
-                event_id=event[0][1:],
-                latitude=float(event[1]),
-                longitude=float(event[2]),
-                date=datetime.datetime.fromisoformat(
-                    event[3] + " " + (event[4] or "12:00:00")
-                ),
-                observer_id=event[5][3:],
-                duration_minutes=None if event[6] == "" else int(float(event[6])),
+
+def missing(name):
+    return schema is None or name not in schema
+
+
+for table, old_indexes in (("sighting", []), ("species_day", ["species_day_cell"])):
+    if schema is None or "common_name" in (schema.get(table) or ""):
+        migrate_species_names(table, old_indexes)
+
+# Replaced by the unique species_day_key
+if schema is None or "species_day_species_cell" in schema:
+    db.executesql("DROP INDEX IF EXISTS species_day_species_cell;")
+
+for kind, indexes in (("INDEX", INDEXES), ("UNIQUE INDEX", UNIQUE_INDEXES)):
+    for name, (table, columns) in indexes.items():
+        if missing(name):
+            db.executesql(
+                "CREATE %s IF NOT EXISTS %s ON %s (%s);"
+                % (kind, name, table, ", ".join(columns))
             )
-            for event in list(checklist)[1:]
-        ]
-    )
 
-if db(db.species).isempty():
-    print("Priming species database...")
-    species = csv.reader(open("sample_data/species.csv"), delimiter=",")
+if HAS_RTREE and any(missing(name) for name in RTREE_OBJECTS):
+    db.executesql(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS checklist_rtree "
+        "USING rtree(id, min_lat, max_lat, min_lng, max_lng);"
+    )
+    # Triggers keep the index in sync with every insert, update and delete
+    db.executesql(
+        """CREATE TRIGGER IF NOT EXISTS checklist_rtree_insert
+        AFTER INSERT ON checklist
+        WHEN new.latitude IS NOT NULL AND new.longitude IS NOT NULL BEGIN
+            INSERT INTO checklist_rtree
+            VALUES (new.id, new.latitude, new.latitude, new.longitude, new.longitude);
+        END;"""
+    )
+    db.executesql(
+        """CREATE TRIGGER IF NOT EXISTS checklist_rtree_update
+        AFTER UPDATE OF latitude, longitude ON checklist BEGIN
+            DELETE FROM checklist_rtree WHERE id = old.id;
+            INSERT INTO checklist_rtree SELECT new.id, new.latitude,
+                new.latitude, new.longitude, new.longitude
+            WHERE new.latitude IS NOT NULL AND new.longitude IS NOT NULL;
+        END;"""
+    )
+    db.executesql(
+        """CREATE TRIGGER IF NOT EXISTS checklist_rtree_delete
+        AFTER DELETE ON checklist BEGIN
+            DELETE FROM checklist_rtree WHERE id = old.id;
+        END;"""
+    )
+    # Index checklists stored before the R*Tree existed
+    if missing("checklist_rtree"):
+        db.executesql(
+            """INSERT INTO checklist_rtree
+            SELECT id, latitude, latitude, longitude, longitude FROM checklist
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL;"""
+        )
 
-    db.species.bulk_insert([dict(name=bird[0]) for bird in list(species)[1:]])
+if HAS_RTREE:
+    db.define_table(
+        "checklist_rtree",
+        Field("min_lat", "double"),
+        Field("max_lat", "double"),
+        Field("min_lng", "double"),
+        Field("max_lng", "double"),
+        migrate=False,
+    )
 
+# Release the write lock taken by the statements above on a new database
 db.commit()
+
+
+# Bound parameters per statement, under the 999 of older SQLite versions
+MAX_PARAMETERS = 900
+
+
+# Insert rows (tuples of values for columns) with multi-row INSERT statements
+def insert_rows(table, columns, rows, suffix=""):
+    marker = "?" if db._adapter.driver.paramstyle == "qmark" else "%s"
+    values = "(%s)" % ", ".join([marker] * len(columns))
+    per_insert = max(1, MAX_PARAMETERS // len(columns))
+    for start in range(0, len(rows), per_insert):
+        chunk = rows[start : start + per_insert]
+        db.executesql(
+            "INSERT INTO %s (%s) VALUES %s%s;"
+            % (table, ", ".join(columns), ", ".join([values] * len(chunk)), suffix),
+            [value for row in chunk for value in row],
+        )
+
+
+# Insert the rows of a select, as made by db(query)._select(...), so that they
+# never leave the database
+def insert_select(table, columns, select, suffix=""):
+    db.executesql(
+        "INSERT INTO %s (%s) %s%s;"
+        % (table, ", ".join(columns), select.rstrip().rstrip(";"), suffix)
+    )
+
+
+# Expressions for the grid cell of a checklist, in cells of size degrees.
+# SQLite's CAST truncates, which floors these non-negative values; other
+# engines like PostgreSQL round, so they floor first.
+def checklist_cells(size):
+    def cell(value):
+        if db._dbname != "sqlite":
+            value = Expression(db, db._adapter.dialect.aggregate, value, "FLOOR", "double")
+        return value.cast("integer")
+
+    return (
+        cell((db.checklist.latitude + 90) / size),
+        cell((db.checklist.longitude + 180) / size),
+    )
+
+
+# Query for the rows whose date or datetime field falls in a periods.Period,
+# or True, which matches every row, when period is None
+def in_period(field, period):
+    if period is None:
+        return True
+    query = field != None
+    if field.type == "datetime":
+        day = lambda date: datetime.datetime.combine(date, datetime.time())
+    else:
+        day = lambda date: date
+    if period.start:
+        query &= field >= day(period.start)
+    if period.stop:
+        query &= field < day(period.stop)
+    if period.months:
+        query &= field.month().belongs(period.months)
+    return query
+
+
+# Query for checklists inside [min_lon, min_lat, max_lon, max_lat]
+# The bounds are exclusive unless half_open, which includes the min edges
+def checklist_in_bounds(bounds, half_open=False):
+    if half_open:
+        query = (db.checklist.longitude >= bounds[0]) & (
+            db.checklist.latitude >= bounds[1]
+        )
+    else:
+        query = (db.checklist.longitude > bounds[0]) & (
+            db.checklist.latitude > bounds[1]
+        )
+    query &= (db.checklist.longitude < bounds[2]) & (
+        db.checklist.latitude < bounds[3]
+    )
+    if HAS_RTREE:
+        # R*Tree boxes are rounded outward, so they only narrow the candidates
+        box = db(
+            (db.checklist_rtree.max_lng >= bounds[0])
+            & (db.checklist_rtree.max_lat >= bounds[1])
+            & (db.checklist_rtree.min_lng <= bounds[2])
+            & (db.checklist_rtree.min_lat <= bounds[3])
+        )._select(db.checklist_rtree.id)
+        query &= db.checklist.id.belongs(box)
+    return query
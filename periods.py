@@ -0,0 +1,70 @@
+"""
+This file parses the time filters of the map and region APIs into a Period:
+
+- from, to: first and last day included, as YYYY-MM-DD
+- months: months of the year included, as 1-12 separated by commas, or
+  season: one of SEASONS (northern hemisphere, by whole months)
+
+Periods are hashable, so they are part of the cache keys of the results.
+"""
+
+import datetime
+from collections import namedtuple
+
+WEEKS = 52  # weekly frames of a year; its last day or two join the last week
+
+SEASONS = {
+    "spring": (3, 4, 5),
+    "summer": (6, 7, 8),
+    "autumn": (9, 10, 11),
+    "fall": (9, 10, 11),
+    "winter": (1, 2, 12),
+}
+
+# start and stop are dates, stop excluded, or None for no limit; months is a
+# sorted tuple, or None for all of them
+Period = namedtuple("Period", ["start", "stop", "months"])
+
+
+# The Period of the query parameters, or None when there are none. Raises
+# ValueError for invalid values.
+def parse_period(query):
+    start, to = parse_date(query.get("from")), parse_date(query.get("to"))
+    months = query.get("months")
+    season = query.get("season")
+    if season:
+        if season not in SEASONS:
+            raise ValueError("Invalid season")
+        months = SEASONS[season]
+    elif months:
+        months = tuple(sorted({int(month) for month in months.split(",")}))
+        if not all(1 <= month <= 12 for month in months):
+            raise ValueError("Invalid months")
+    else:
+        months = None
+    if months and len(months) == 12:
+        months = None
+    stop = to + datetime.timedelta(days=1) if to else None
+    if start is None and stop is None and months is None:
+        return None
+    return Period(start, stop, months)
+
+
+def parse_date(value):
+    if not value:
+        return None
+    return datetime.date.fromisoformat(value)
+
+
+# Whether a date falls in the period
+def contains(period, day):
+    return (
+        (period.start is None or day >= period.start)
+        and (period.stop is None or day < period.stop)
+        and (period.months is None or day.month in period.months)
+    )
+
+
+# Week of the year of a date, from 0 to WEEKS - 1
+def week_of_year(day):
+    return min((day.timetuple().tm_yday - 1) // 7, WEEKS - 1)
@@ -0,0 +1,671 @@
+"""
+This file maintains three rollups over the same grid: species_day, the total
+birds per species, cell and day, species_week, the same per week of the year,
+and observer_cell, the checklists per observer and cell. Cells that lie
+entirely inside a query box are answered from the rollups; only the strips
+along the box edges still read raw checklists.
+
+Alongside, species_sketch keeps a HyperLogLog sketch of the species of each
+cell, merged at query time into the species richness of boxes of cells.
+
+It also maintains cluster_cell, the checklists clustered on the grid of each
+map zoom level up to grid.CLUSTER_MAX_ZOOM, in the manner of supercluster.
+
+The rebuilds run in the database, with INSERT ... SELECT. Each transaction
+first deletes the rows it replaces: on SQLite, that takes the write lock before
+it reads, so no write falls between its reads and its inserts.
+"""
+
+import datetime
+import heapq
+from functools import reduce
+from pydal.objects import Expression
+from .common import db, settings, columnar
+from .models import (
+    checklist_cells,
+    checklist_in_bounds,
+    in_period,
+    insert_rows,
+    insert_select,
+)
+from . import grid, periods, sketches
+
+SIZE = settings.ROLLUP_CELL_SIZE
+EPSILON = 1e-9  # Overlap between edge strips and the interior, in degrees
+REBUILD_DAYS = 1  # Days of checklists rebuilt per transaction
+REBUILD_SPECIES = 100  # Species of species_week rebuilt per transaction
+
+GRANULARITIES = {
+    "day": lambda day: day,
+    "week": lambda day: day - datetime.timedelta(days=day.weekday()),
+    "month": lambda day: day.replace(day=1),
+}
+
+
+# Add (sign=1) or remove (sign=-1) a checklist and its sightings from the rollups
+def update(checklist, sightings, sign=1):
+    lat_cell, lng_cell = grid.cell_index(checklist.latitude, checklist.longitude, SIZE)
+    day = checklist.date.date()
+    totals = {}
+    for sighting in sightings:
+        species_id = sighting.species_id
+        totals[species_id] = totals.get(species_id, 0) + (sighting.count or 0)
+
+    insert_rows(
+        "species_day",
+        ["species_id", "day", "lat_cell", "lng_cell", "total"],
+        [
+            (species_id, day.isoformat(), lat_cell, lng_cell, sign * total)
+            for species_id, total in totals.items()
+        ],
+        " ON CONFLICT (species_id, lat_cell, lng_cell, day)"
+        " DO UPDATE SET total = species_day.total + excluded.total",
+    )
+    week = periods.week_of_year(day)
+    insert_rows(
+        "species_week",
+        ["species_id", "week", "lat_cell", "lng_cell", "total"],
+        [
+            (species_id, week, lat_cell, lng_cell, sign * total)
+            for species_id, total in totals.items()
+        ],
+        " ON CONFLICT (species_id, lat_cell, lng_cell, week)"
+        " DO UPDATE SET total = species_week.total + excluded.total",
+    )
+    if sign < 0:
+        db(
+            (db.species_day.lat_cell == lat_cell)
+            & (db.species_day.lng_cell == lng_cell)
+            & (db.species_day.day == day)
+            & (db.species_day.total <= 0)
+        ).delete()
+        db(
+            (db.species_week.lat_cell == lat_cell)
+            & (db.species_week.lng_cell == lng_cell)
+            & (db.species_week.week == week)
+            & (db.species_week.total <= 0)
+        ).delete()
+
+    if sign < 0 or totals:
+        update_sketch(lat_cell, lng_cell, totals if sign > 0 else None)
+
+    birds = sum(totals.values())
+    cells = [
+        (zoom,) + grid.cell_index(checklist.latitude, checklist.longitude, grid.cell_size(zoom))
+        for zoom in range(grid.CLUSTER_MAX_ZOOM + 1)
+    ]
+    insert_rows(
+        "cluster_cell",
+        ["zoom", "lat_cell", "lng_cell", "checklists", "birds", "lat_sum", "lng_sum"],
+        [
+            cell + (sign, sign * birds, sign * checklist.latitude, sign * checklist.longitude)
+            for cell in cells
+        ],
+        " ON CONFLICT (zoom, lat_cell, lng_cell) DO UPDATE SET"
+        " checklists = cluster_cell.checklists + excluded.checklists,"
+        " birds = cluster_cell.birds + excluded.birds,"
+        " lat_sum = cluster_cell.lat_sum + excluded.lat_sum,"
+        " lng_sum = cluster_cell.lng_sum + excluded.lng_sum",
+    )
+    if sign < 0:
+        db(
+            reduce(
+                lambda a, b: a | b,
+                [
+                    (db.cluster_cell.zoom == zoom)
+                    & (db.cluster_cell.lat_cell == lat)
+                    & (db.cluster_cell.lng_cell == lng)
+                    for zoom, lat, lng in cells
+                ],
+            )
+            & (db.cluster_cell.checklists <= 0)
+        ).delete()
+
+    insert_rows(
+        "observer_cell",
+        ["observer_id", "lat_cell", "lng_cell", "checklists"],
+        [(checklist.observer_id, lat_cell, lng_cell, sign)],
+        " ON CONFLICT (lat_cell, lng_cell, observer_id)"
+        " DO UPDATE SET checklists = observer_cell.checklists + excluded.checklists",
+    )
+    if sign < 0:
+        db(
+            (db.observer_cell.lat_cell == lat_cell)
+            & (db.observer_cell.lng_cell == lng_cell)
+            & (db.observer_cell.observer_id == checklist.observer_id)
+            & (db.observer_cell.checklists <= 0)
+        ).delete()
+
+
+# Add species to the sketch of a cell, or with None, recompute it from
+# species_day, as sketches can't forget a species
+def update_sketch(lat_cell, lng_cell, species_ids=None):
+    cell = (db.species_sketch.lat_cell == lat_cell) & (
+        db.species_sketch.lng_cell == lng_cell
+    )
+    if species_ids is None:
+        registers = bytearray(sketches.REGISTERS)
+        species_ids = [
+            row.species_id
+            for row in db(
+                (db.species_day.lat_cell == lat_cell)
+                & (db.species_day.lng_cell == lng_cell)
+            ).iterselect(db.species_day.species_id, distinct=True)
+        ]
+        if not species_ids:
+            db(cell).delete()
+            return
+    else:
+        # Creating or touching the row first locks it, so that writers of the
+        # same cell add their species in turn
+        insert_rows(
+            "species_sketch",
+            ["lat_cell", "lng_cell", "registers"],
+            [(lat_cell, lng_cell, sketches.encode(bytearray(sketches.REGISTERS)))],
+            " ON CONFLICT (lat_cell, lng_cell)"
+            " DO UPDATE SET registers = species_sketch.registers",
+        )
+        row = db(cell).select(db.species_sketch.registers).first()
+        registers = sketches.decode(row.registers)
+    for species_id in species_ids:
+        sketches.add(registers, species_id)
+    insert_rows(
+        "species_sketch",
+        ["lat_cell", "lng_cell", "registers"],
+        [(lat_cell, lng_cell, sketches.encode(registers))],
+        " ON CONFLICT (lat_cell, lng_cell)"
+        " DO UPDATE SET registers = excluded.registers",
+    )
+
+
+# Recompute species_day, then species_week and species_sketch, from the
+# sighting and checklist tables, REBUILD_DAYS days of checklists at a time.
+# Each batch is replaced in a transaction of its own, so writers only wait for
+# one batch; their updates of the other days are kept, or replaced with the
+# rest of their batch.
+def rebuild():
+    for period in rebuild_periods():
+        db(in_period(db.species_day.day, period)).delete()
+        lat_cell, lng_cell = checklist_cells(SIZE)
+        day = checklist_day()
+        total = db.sighting.count.sum().coalesce_zero()
+        insert_select(
+            "species_day",
+            ["species_id", "day", "lat_cell", "lng_cell", "total"],
+            db(
+                (db.sighting.event_id == db.checklist.event_id)
+                & in_period(db.checklist.date, period)
+            )._select(
+                db.sighting.species_id,
+                day,
+                lat_cell,
+                lng_cell,
+                total,
+                groupby=db.sighting.species_id | day | lat_cell | lng_cell,
+            ),
+        )
+        db.commit()
+    rebuild_weeks()
+    rebuild_sketches()
+
+
+# Consecutive periods.Periods of REBUILD_DAYS days over the checklist dates.
+# The first starts and the last stops nowhere, so that they also cover the
+# rows of any other date, even of checklists added meanwhile.
+def rebuild_periods():
+    first, last = db.checklist.date.min(), db.checklist.date.max()
+    row = db(db.checklist).select(first, last).first()
+    starts = []
+    if row[first] is not None:
+        day = row[first].date() + datetime.timedelta(days=REBUILD_DAYS)
+        while day <= row[last].date():
+            starts.append(day)
+            day += datetime.timedelta(days=REBUILD_DAYS)
+    bounds = [None] + starts + [None]
+    return [
+        periods.Period(start, stop, None) for start, stop in zip(bounds, bounds[1:])
+    ]
+
+
+# Expression for the day of a checklist's date
+def checklist_day():
+    return Expression(
+        db, db._adapter.dialect.aggregate, db.checklist.date, "DATE", "date"
+    )
+
+
+# Recompute species_week from species_day, REBUILD_SPECIES species at a
+# time, each batch in a transaction of its own like those of rebuild()
+def rebuild_weeks():
+    ids = [
+        row.id for row in db(db.species).select(db.species.id, orderby=db.species.id)
+    ]
+    bounds = [None] + ids[REBUILD_SPECIES::REBUILD_SPECIES] + [None]
+    week = week_of(db.species_day.day)
+    for low, high in zip(bounds, bounds[1:]):
+        db(species_range(db.species_week.species_id, low, high)).delete()
+        insert_select(
+            "species_week",
+            ["species_id", "week", "lat_cell", "lng_cell", "total"],
+            db(species_range(db.species_day.species_id, low, high))._select(
+                db.species_day.species_id,
+                week,
+                db.species_day.lat_cell,
+                db.species_day.lng_cell,
+                db.species_day.total.sum(),
+                groupby=db.species_day.species_id
+                | week
+                | db.species_day.lat_cell
+                | db.species_day.lng_cell,
+            ),
+        )
+        db.commit()
+
+
+# Query for the rows of the species ids from low to high, high excluded, where
+# None leaves that end open. Rows without a species fall in the first range.
+def species_range(field, low, high):
+    if low is None:
+        upper = field < high if high is not None else field != None
+        return (field == None) | upper
+    query = field >= low
+    return query & (field < high) if high is not None else query
+
+
+# Expression for periods.week_of_year of a date field
+def week_of(field):
+    if db._dbname == "sqlite":
+        day = "CAST(strftime('%%j', %s) AS INTEGER)"
+    else:
+        day = "CAST(EXTRACT(DOY FROM %s) AS INTEGER)"
+    day %= db._adapter.expand(field)
+    last = periods.WEEKS - 1
+    return Expression(
+        db,
+        "CASE WHEN %s > %d THEN %d ELSE (%s - 1) / 7 END" % (day, 7 * last, last, day),
+        type="integer",
+    )
+
+
+# Recompute the species_sketch rollup from species_day
+def rebuild_sketches():
+    db(db.species_sketch).delete()
+    registers = {}
+    for row in db(db.species_day).iterselect(
+        db.species_day.lat_cell,
+        db.species_day.lng_cell,
+        db.species_day.species_id,
+        distinct=True,
+    ):
+        cell = (row.lat_cell, row.lng_cell)
+        if cell not in registers:
+            registers[cell] = bytearray(sketches.REGISTERS)
+        sketches.add(registers[cell], row.species_id)
+
+    insert_rows(
+        "species_sketch",
+        ["lat_cell", "lng_cell", "registers"],
+        [cell + (sketches.encode(r),) for cell, r in registers.items()],
+    )
+    db.commit()
+
+
+# Recompute the observer_cell rollup from the checklist table
+def rebuild_contributors():
+    db(db.observer_cell).delete()
+    lat_cell, lng_cell = checklist_cells(SIZE)
+    insert_select(
+        "observer_cell",
+        ["observer_id", "lat_cell", "lng_cell", "checklists"],
+        db(db.checklist.latitude != None)._select(
+            db.checklist.observer_id,
+            lat_cell,
+            lng_cell,
+            db.checklist.id.count(),
+            groupby=db.checklist.observer_id | lat_cell | lng_cell,
+        ),
+    )
+    db.commit()
+
+
+# Recompute the cluster_cell rollup from the checklist and sighting tables,
+# one zoom per transaction. The deepest zoom is read from the checklists and
+# their sightings, each one above from the zoom below it, as its cells halve.
+def rebuild_clusters():
+    columns = ["zoom", "lat_cell", "lng_cell", "checklists", "birds"]
+    columns += ["lat_sum", "lng_sum"]
+    zoom = grid.CLUSTER_MAX_ZOOM
+    lat_cell, lng_cell = checklist_cells(grid.cell_size(zoom))
+    db(db.cluster_cell.zoom == zoom).delete()
+    insert_select(
+        "cluster_cell",
+        columns,
+        db(db.checklist.latitude != None)._select(
+            constant(zoom),
+            lat_cell,
+            lng_cell,
+            db.checklist.id.count(),
+            constant(0),
+            db.checklist.latitude.sum(),
+            db.checklist.longitude.sum(),
+            groupby=lat_cell | lng_cell,
+        ),
+    )
+    # The birds, added to the cells just made
+    insert_select(
+        "cluster_cell",
+        ["zoom", "lat_cell", "lng_cell", "birds"],
+        db(
+            (db.sighting.event_id == db.checklist.event_id)
+            & (db.checklist.latitude != None)
+        )._select(
+            constant(zoom),
+            lat_cell,
+            lng_cell,
+            db.sighting.count.sum().coalesce_zero(),
+            groupby=lat_cell | lng_cell,
+        ),
+        " ON CONFLICT (zoom, lat_cell, lng_cell) DO UPDATE SET birds = excluded.birds",
+    )
+    db.commit()
+
+    cell = db.cluster_cell
+    for zoom in range(grid.CLUSTER_MAX_ZOOM - 1, -1, -1):
+        db(cell.zoom == zoom).delete()
+        lat_cell, lng_cell = cell.lat_cell / 2, cell.lng_cell / 2
+        insert_select(
+            "cluster_cell",
+            columns,
+            db(cell.zoom == zoom + 1)._select(
+                constant(zoom),
+                lat_cell,
+                lng_cell,
+                cell.checklists.sum(),
+                cell.birds.sum(),
+                cell.lat_sum.sum(),
+                cell.lng_sum.sum(),
+                groupby=lat_cell | lng_cell,
+            ),
+        )
+        db.commit()
+
+
+# Expression for an integer constant, to select into a column
+def constant(value):
+    return Expression(db, str(int(value)), type="integer")
+
+
+# Recompute every rollup, after data was loaded around update(), like by
+# sample_data/dbpopulator.py
+def rebuild_all():
+    rebuild()
+    rebuild_contributors()
+    rebuild_clusters()
+
+
+# Range of cells (lat_min, lat_max, lng_min, lng_max) strictly inside bounds
+def interior_cells(bounds):
+    lat_min, lng_min = grid.cell_index(bounds[1], bounds[0], SIZE)
+    lat_max, lng_max = grid.cell_index(bounds[3], bounds[2], SIZE)
+    cells = (lat_min + 1, lat_max - 1, lng_min + 1, lng_max - 1)
+    if cells[0] > cells[1] or cells[2] > cells[3]:
+        return None
+    return cells
+
+
+# Total count of a species per day, week or month inside the bounds, during
+# the periods.Period if given
+@columnar
+def species_trend(species_id, bounds, granularity="day", period=None):
+    bucket = GRANULARITIES[granularity]
+    bounds = grid.clip_bounds(bounds)
+    totals = {}
+
+    cells = interior_cells(bounds)
+    edges = checklist_in_bounds(bounds)
+    if cells:
+        # Whole cells come straight from the rollup
+        total = db.species_day.total.sum()
+        rows = db(
+            (db.species_day.species_id == species_id)
+            & (db.species_day.lat_cell >= cells[0])
+            & (db.species_day.lat_cell <= cells[1])
+            & (db.species_day.lng_cell >= cells[2])
+            & (db.species_day.lng_cell <= cells[3])
+            & in_period(db.species_day.day, period)
+        ).select(db.species_day.day, total, groupby=db.species_day.day)
+        for row in rows:
+            key = bucket(row.species_day.day)
+            totals[key] = totals.get(key, 0) + row[total]
+        edges = edge_strips(bounds, cells)
+
+    # Checklists outside the whole cells are read one by one
+    query = (
+        (db.sighting.event_id == db.checklist.event_id)
+        & (db.sighting.species_id == species_id)
+        & edges
+        & in_period(db.checklist.date, period)
+    )
+    if cells:
+        query &= outside_cells(cells)
+    for row in db(query).iterselect(db.checklist.date, db.sighting.count):
+        key = bucket(row.checklist.date.date())
+        totals[key] = totals.get(key, 0) + (row.sighting.count or 0)
+
+    return sorted(totals.items())
+
+
+# The limit observers with the most checklists inside the bounds, as
+# (observer_id, checklists) pairs, most active first. The rollup has no
+# dates, so with a periods.Period every checklist is read.
+@columnar
+def top_contributors(bounds, period=None, limit=5):
+    bounds = grid.clip_bounds(bounds)
+    counts = {}
+
+    cells = interior_cells(bounds) if period is None else None
+    query = checklist_in_bounds(bounds) & in_period(db.checklist.date, period)
+    if cells:
+        # Whole cells come from the rollup, summed per observer across cells
+        total = db.observer_cell.checklists.sum()
+        rows = db(
+            (db.observer_cell.lat_cell >= cells[0])
+            & (db.observer_cell.lat_cell <= cells[1])
+            & (db.observer_cell.lng_cell >= cells[2])
+            & (db.observer_cell.lng_cell <= cells[3])
+        ).iterselect(
+            db.observer_cell.observer_id, total, groupby=db.observer_cell.observer_id
+        )
+        for row in rows:
+            counts[row.observer_cell.observer_id] = row[total]
+        query = edge_strips(bounds, cells) & outside_cells(cells)
+
+    checklists = db.checklist.id.count()
+    for row in db(query).iterselect(
+        db.checklist.observer_id, checklists, groupby=db.checklist.observer_id
+    ):
+        observer_id = row.checklist.observer_id
+        counts[observer_id] = counts.get(observer_id, 0) + row[checklists]
+
+    # A heap of size limit, rather than sorting every observer; ties by id
+    return heapq.nsmallest(limit, counts.items(), key=lambda item: (-item[1], item[0]))
+
+
+# For each week of the year, a frame of [lat, lng, total] per cell of size
+# degrees, at the center of the cell, for the rollup cells overlapping the
+# bounds. species_week answers, unless a periods.Period needs the days of
+# species_day. The size should be at least the rollup's.
+def weekly_frames(species_ids, bounds, size, period=None):
+    bounds = grid.clip_bounds(bounds)
+    lat_min, lng_min = grid.cell_index(bounds[1], bounds[0], SIZE)
+    lat_max, lng_max = grid.cell_index(bounds[3], bounds[2], SIZE)
+    table = db.species_day if period else db.species_week
+    query = (
+        (table.lat_cell >= lat_min)
+        & (table.lat_cell <= lat_max)
+        & (table.lng_cell >= lng_min)
+        & (table.lng_cell <= lng_max)
+    )
+    if species_ids is not None:
+        query &= table.species_id.belongs(species_ids)
+    total = table.total.sum()
+    if period:
+        query &= in_period(table.day, period)
+        time, week = table.day, lambda row: periods.week_of_year(row[table.day])
+    else:
+        time, week = table.week, lambda row: row[table.week]
+    rows = db(query).iterselect(
+        time,
+        table.lat_cell,
+        table.lng_cell,
+        total,
+        groupby=time | table.lat_cell | table.lng_cell,
+    )
+
+    frames = [{} for _ in range(periods.WEEKS)]
+    for row in rows:
+        cell = grid.cell_index(
+            (row[table.lat_cell] + 0.5) * SIZE - 90,
+            (row[table.lng_cell] + 0.5) * SIZE - 180,
+            size,
+        )
+        frame = frames[week(row)]
+        frame[cell] = frame.get(cell, 0) + (row[total] or 0)
+    return [
+        [
+            [(lat + 0.5) * size - 90, (lng + 0.5) * size - 180, n]
+            for (lat, lng), n in sorted(frame.items())
+        ]
+        for frame in frames
+    ]
+
+
+# The clusters of the zoom level overlapping the bounds, as [lat, lng,
+# checklists, birds] at the mean position of their checklists. Zooms past
+# grid.CLUSTER_MAX_ZOOM get its clusters, which are already about single sites.
+def clusters(bounds, zoom):
+    zoom = min(max(int(zoom), 0), grid.CLUSTER_MAX_ZOOM)
+    size = grid.cell_size(zoom)
+    bounds = grid.clip_bounds(bounds)
+    lat_min, lng_min = grid.cell_index(bounds[1], bounds[0], size)
+    lat_max, lng_max = grid.cell_index(bounds[3], bounds[2], size)
+    rows = db(
+        (db.cluster_cell.zoom == zoom)
+        & (db.cluster_cell.lat_cell >= lat_min)
+        & (db.cluster_cell.lat_cell <= lat_max)
+        & (db.cluster_cell.lng_cell >= lng_min)
+        & (db.cluster_cell.lng_cell <= lng_max)
+    ).iterselect(
+        db.cluster_cell.checklists,
+        db.cluster_cell.birds,
+        db.cluster_cell.lat_sum,
+        db.cluster_cell.lng_sum,
+    )
+    return [
+        [row.lat_sum / row.checklists, row.lng_sum / row.checklists, row.checklists, row.birds]
+        for row in rows
+    ]
+
+
+# The number of species per cell of size degrees, as [lat, lng, species] at
+# the center of the cell, for the rollup cells overlapping the bounds, and
+# the number for all of them, as (cells, richness). The numbers are estimates
+# from the merged sketches of the cells, see sketches.py for their error.
+# With species or a periods.Period, the sketches can't tell, so the distinct
+# species of species_day are counted exactly. The size should be at least
+# the rollup's.
+def richness_cells(species_ids, bounds, size, period=None):
+    bounds = grid.clip_bounds(bounds)
+    lat_min, lng_min = grid.cell_index(bounds[1], bounds[0], SIZE)
+    lat_max, lng_max = grid.cell_index(bounds[3], bounds[2], SIZE)
+    exact = species_ids is not None or period is not None
+    table = db.species_day if exact else db.species_sketch
+    query = (
+        (table.lat_cell >= lat_min)
+        & (table.lat_cell <= lat_max)
+        & (table.lng_cell >= lng_min)
+        & (table.lng_cell <= lng_max)
+    )
+    if exact:
+        if species_ids is not None:
+            query &= table.species_id.belongs(species_ids)
+        query &= in_period(table.day, period)
+        rows = db(query).iterselect(
+            table.lat_cell, table.lng_cell, table.species_id, distinct=True
+        )
+    else:
+        rows = db(query).iterselect(table.lat_cell, table.lng_cell, table.registers)
+
+    cells = {}
+    for row in rows:
+        cell = grid.cell_index(
+            (row.lat_cell + 0.5) * SIZE - 90,
+            (row.lng_cell + 0.5) * SIZE - 180,
+            size,
+        )
+        if exact:
+            cells.setdefault(cell, set()).add(row.species_id)
+        else:
+            cells.setdefault(cell, []).append(sketches.decode(row.registers))
+    if exact:
+        union, count = set().union(*cells.values()), len
+    else:
+        cells = {cell: sketches.merge(group) for cell, group in cells.items()}
+        union, count = sketches.merge(cells.values()), sketches.estimate
+    return (
+        [
+            [(lat + 0.5) * size - 90, (lng + 0.5) * size - 180, count(species)]
+            for (lat, lng), species in sorted(cells.items())
+        ],
+        count(union),
+    )
+
+
+# Query for the checklists in the bounds but near or outside the whole cells
+def edge_strips(bounds, cells):
+    south = cells[0] * SIZE - 90 - EPSILON
+    north = (cells[1] + 1) * SIZE - 90 + EPSILON
+    west = cells[2] * SIZE - 180 - EPSILON
+    east = (cells[3] + 1) * SIZE - 180 + EPSILON
+    strips = [
+        [bounds[0], bounds[1], bounds[2], south + 2 * EPSILON],
+        [bounds[0], north - 2 * EPSILON, bounds[2], bounds[3]],
+        [bounds[0], south, west + 2 * EPSILON, north],
+        [east - 2 * EPSILON, south, bounds[2], north],
+    ]
+    return reduce(lambda a, b: a | b, [checklist_in_bounds(s) for s in strips])
+
+
+# Query for the checklists outside a range of cells
+def outside_cells(cells):
+    lat_cell, lng_cell = checklist_cells(SIZE)
+    return ~(
+        (lat_cell >= cells[0])
+        & (lat_cell <= cells[1])
+        & (lng_cell >= cells[2])
+        & (lng_cell <= cells[3])
+    )
+
+
+# Fill the rollups of databases created before they existed; returns whether
+# any was. Run by tasks.backfill_rollups rather than on import. The empty ones
+# are all found first, as the writes served meanwhile add rows to each.
+# rebuild() also fills species_week and species_sketch, from species_day.
+def backfill():
+    if db(db.checklist).isempty():
+        return False
+    rebuilds = {
+        "species_day": rebuild,
+        "observer_cell": rebuild_contributors,
+        "species_week": rebuild_weeks,
+        "species_sketch": rebuild_sketches,
+        "cluster_cell": rebuild_clusters,
+    }
+    empty = [name for name in rebuilds if db(db[name]).isempty()]
+    if "species_day" in empty:
+        empty = [
+            name for name in empty if name not in ("species_week", "species_sketch")
+        ]
+    for name in empty:
+        rebuilds[name]()
+    return bool(empty)
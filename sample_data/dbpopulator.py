@@ -1,48 +1,235 @@
-import sqlite3
+"""
+Streams eBird-format CSV files into the app database.
+
+Rows are read in fixed-size chunks and written with executemany, one
+transaction per chunk, so memory stays bounded whatever the file size. The
+number of rows committed per file is recorded in the import_progress table,
+and an interrupted import resumes where it stopped when run again.
+
+The app is imported, as py4web does, from its folder in the apps folder: its
+models create the tables, and its own rollups.py rebuilds the rollups once the
+rows are in. From the app folder:
+
+    python sample_data/dbpopulator.py
+    python sample_data/dbpopulator.py --sightings path/to/ebd.csv --chunk-size 50000
+"""
+
+import argparse
 import csv
 import datetime
+import importlib.util
+import os
+import sys
+import time
 
-if __name__ == "__main__":
-    checklist = csv.reader(open("app/Bird-Watcher/sample_data/checklists.csv"), delimiter=",")
-    sightings = csv.reader(open("app/Bird-Watcher/sample_data/sightings.csv"), delimiter=",")
-    species = csv.reader(open("app/Bird-Watcher/sample_data/species.csv"), delimiter=",")
-
-    conn = sqlite3.connect("app/Bird-Watcher/databases/storage.db")
-    cursor = conn.cursor()
-
-    for event in list(checklist)[1:]:
-        event = (
-            event[0][1:],
-            event[1],
-            event[2],
-            event[3] + " " + (event[4] or "12:00:00"),
-            event[5][3:],
-            None if event[6] == '' else event[6],
-        )
-        # print(event)
-        cursor.execute(
-            """INSERT INTO checklist(event_id, latitude, longitude, date, observer_id, duration_minutes)
-            VALUES (?, ?, ?, ?, ?, ?)""",
-            event,
-        )
+SAMPLE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+APP_FOLDER = os.path.dirname(SAMPLE_FOLDER)
+
+
+# Loads a module of the app, like its settings, without importing the app itself
+def load_module(name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(APP_FOLDER, name + ".py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_settings():
+    return load_module("settings")
+
+
+# The app in app_folder, imported as apps.<name> like py4web does, which
+# starts none of its background jobs
+def load_app(app_folder=APP_FOLDER):
+    apps_folder = os.path.dirname(os.path.abspath(app_folder))
+    sys.path.insert(0, os.path.dirname(apps_folder))
+    import py4web.core
+
+    return importlib.import_module(
+        "%s.%s" % (os.path.basename(apps_folder), os.path.basename(app_folder))
+    )
+
+
+# Recompute the rollups of the loaded rows with the app's rollups.py, then
+# drop the results that its running workers cached from the old ones
+def rebuild_rollups(app):
+    print("Rebuilding rollups...")
+    importlib.import_module(app.__name__ + ".rollups").rebuild_all()
+    app.db.commit()
+    importlib.import_module(app.__name__ + ".common").result_cache.bump()
+
+
+# Column name -> function turning a CSV row into a column value
+def species_columns(header):
+    name = header.index("COMMON NAME")
+    return {"name": lambda row: row[name]}
 
-    for sighting in list(sightings)[1:]:
-        sighting = (
-            sighting[0][1:],
-            sighting[1],
-            1 if sighting[2] == 'X' else sighting[2],
+
+def checklist_columns(header):
+    event = header.index("SAMPLING EVENT IDENTIFIER")
+    lat = header.index("LATITUDE")
+    lng = header.index("LONGITUDE")
+    date = header.index("OBSERVATION DATE")
+    time_started = header.index("TIME OBSERVATIONS STARTED")
+    observer = header.index("OBSERVER ID")
+    duration = header.index("DURATION MINUTES")
+    return {
+        "event_id": lambda row: row[event][1:],
+        "latitude": lambda row: float(row[lat]),
+        "longitude": lambda row: float(row[lng]),
+        "date": lambda row: datetime.datetime.fromisoformat(
+            row[date] + " " + (row[time_started] or "12:00:00")
+        ),
+        "observer_id": lambda row: row[observer][3:],
+        "duration_minutes": lambda row: (
+            None if row[duration] == "" else int(float(row[duration]))
+        ),
+    }
+
+
+def sighting_columns(header, species_ids):
+    event = header.index("SAMPLING EVENT IDENTIFIER")
+    name = header.index("COMMON NAME")
+    count = header.index("OBSERVATION COUNT")
+    return {
+        "event_id": lambda row: row[event][1:],
+        "species_id": lambda row: species_ids[row[name]],
+        "count": lambda row: 1 if row[count] == "X" else int(row[count]),
+    }
+
+
+class Importer:
+    def __init__(self, db, chunk_size):
+        self.db = db
+        self.chunk_size = chunk_size
+        self.cursor = db._adapter.cursor
+        self.marker = "?" if db._adapter.driver.paramstyle == "qmark" else "%s"
+        self.db.executesql(
+            "CREATE TABLE IF NOT EXISTS import_progress "
+            "(filename VARCHAR(512) PRIMARY KEY, rows_done INTEGER);"
         )
-        cursor.execute(
-            """INSERT INTO sighting(event_id, common_name, count)
-            VALUES (?, ?, ?)""",
-            sighting,
+        self.db.commit()
+
+    # Species name -> id, adding the species that are not in the table yet
+    def species_ids(self):
+        importer = self
+
+        class SpeciesIds(dict):
+            def __missing__(self, name):
+                importer.db.executesql(
+                    "INSERT INTO species (name) VALUES (%s) ON CONFLICT DO NOTHING;"
+                    % importer.marker,
+                    [name],
+                )
+                self.update(importer.db.executesql("SELECT name, id FROM species;"))
+                return self[name]
+
+        return SpeciesIds(self.db.executesql("SELECT name, id FROM species;"))
+
+    def rows_done(self, filename):
+        rows = self.db.executesql(
+            "SELECT rows_done FROM import_progress WHERE filename = %s;" % self.marker,
+            [filename],
         )
+        return rows[0][0] if rows else 0
 
-    for bird in list(species)[1:]:
-        cursor.execute(
-            """INSERT INTO species(name)
-            VALUES (?)""",
-            bird,
+    def import_file(self, path, table, columns, on_conflict=""):
+        filename = os.path.abspath(path)
+        done = self.rows_done(filename)
+        with open(path, newline="") as f:
+            reader = csv.reader(f)
+            getters = columns(next(reader))
+            sql = "INSERT INTO %s (%s) VALUES (%s)%s;" % (
+                table,
+                ", ".join(getters),
+                ", ".join([self.marker] * len(getters)),
+                on_conflict,
+            )
+            # Skip the rows committed by a previous run
+            for _ in range(done):
+                next(reader)
+            if done:
+                print("%s: resuming after %d rows" % (path, done))
+
+            start = time.time()
+            imported = 0
+            chunk = []
+            for row in reader:
+                chunk.append(tuple(get(row) for get in getters.values()))
+                if len(chunk) == self.chunk_size:
+                    done = self.write(filename, sql, chunk, done)
+                    imported += len(chunk)
+                    chunk = []
+                    self.report(path, done, imported, start)
+            if chunk:
+                done = self.write(filename, sql, chunk, done)
+                imported += len(chunk)
+            self.report(path, done, imported, start)
+            print()
+        return imported
+
+    # Inserts a chunk and records the progress in the same transaction
+    def write(self, filename, sql, chunk, done):
+        try:
+            self.cursor.executemany(sql, chunk)
+            done += len(chunk)
+            self.db.executesql(
+                "DELETE FROM import_progress WHERE filename = %s;" % self.marker,
+                [filename],
+            )
+            self.db.executesql(
+                "INSERT INTO import_progress (filename, rows_done) VALUES (%s, %s);"
+                % (self.marker, self.marker),
+                [filename, done],
+            )
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return done
+
+    def report(self, path, done, imported, start):
+        elapsed = max(time.time() - start, 1e-9)
+        sys.stdout.write(
+            "\r%s: %d rows, %d this run, %d rows/s"
+            % (path, done, imported, imported / elapsed)
         )
+        sys.stdout.flush()
+
 
-    conn.commit()
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(
+        description="Stream eBird-format CSV files into the app database."
+    )
+    parser.add_argument(
+        "--species", default=os.path.join(SAMPLE_FOLDER, "species.csv")
+    )
+    parser.add_argument(
+        "--checklists", default=os.path.join(SAMPLE_FOLDER, "checklists.csv")
+    )
+    parser.add_argument(
+        "--sightings", default=os.path.join(SAMPLE_FOLDER, "sightings.csv")
+    )
+    parser.add_argument("--chunk-size", type=int, default=10000)
+    args = parser.parse_args()
+
+    app = load_app()
+    importer = Importer(app.db, args.chunk_size)
+    importer.import_file(
+        args.species, "species", species_columns, " ON CONFLICT DO NOTHING"
+    )
+    importer.import_file(args.checklists, "checklist", checklist_columns)
+    species_ids = importer.species_ids()
+    importer.import_file(
+        args.sightings,
+        "sighting",
+        lambda header: sighting_columns(header, species_ids),
+    )
+    rebuild_rollups(app)
+    app.db.close()
+
+
+if __name__ == "__main__":
+    main()
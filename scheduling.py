@@ -0,0 +1,117 @@
+"""
+This file defines the in-process task backend used when USE_CELERY is off. It
+implements the part of the Celery API that tasks.py uses, so the same tasks run
+on a thread pool in the web process or on Celery workers.
+"""
+
+import functools
+import os
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LocalTask:
+    def __init__(self, scheduler, func):
+        self.scheduler = scheduler
+        self.func = func
+        self.name = func.__name__
+        functools.update_wrapper(self, func)
+
+    # Runs the task now, in the calling thread
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def delay(self, *args, **kwargs):
+        return self.apply_async(args, kwargs)
+
+    # Queues the task. A call identical to one that hasn't started yet is
+    # merged with it, so bursts of writes trigger one refresh.
+    def apply_async(self, args=(), kwargs=None, countdown=None):
+        kwargs = kwargs or {}
+        key = (self.name, args, tuple(sorted(kwargs.items())))
+        with self.scheduler.lock:
+            if key in self.scheduler.pending:
+                return self.scheduler.pending[key]
+            return self.scheduler.submit(key, (self.func, args, kwargs, countdown))
+
+
+class LocalScheduler:
+    """
+    Runs tasks on a thread pool, and the tasks of conf.beat_schedule
+    ({"name": {"task": "dotted.name", "schedule": seconds, "args": ()}})
+    periodically once start() is called. Forked worker processes get their own
+    threads, and run again the calls that hadn't finished at the fork.
+    """
+
+    def __init__(self, workers=2, logger=None):
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="task")
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.tasks = {}  # name -> LocalTask
+        self.pending = {}  # call key -> future, until the call starts
+        self.calls = {}  # call key -> (func, args, kwargs, countdown), until it ends
+        self.conf = types.SimpleNamespace(beat_schedule={})
+        self.beat = None
+        os.register_at_fork(after_in_child=self.after_fork)
+
+    def task(self, func):
+        task = LocalTask(self, func)
+        self.tasks[task.name] = task
+        return task
+
+    # Call with the lock held
+    def submit(self, key, call):
+        future = self.pool.submit(self.run, key, *call)
+        self.pending[key] = future
+        self.calls[key] = call
+        return future
+
+    def run(self, key, func, args, kwargs, countdown):
+        if countdown:
+            time.sleep(countdown)
+        with self.lock:
+            self.pending.pop(key, None)
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Task %s failed" % key[0])
+            raise
+        finally:
+            with self.lock:
+                # Unless the same call was queued again meanwhile
+                if key not in self.pending:
+                    self.calls.pop(key, None)
+
+    # Only the forking thread lives on in the child
+    def after_fork(self):
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix="task"
+        )
+        calls, self.calls, self.pending = self.calls, {}, {}
+        with self.lock:
+            for key, call in calls.items():
+                self.submit(key, call)
+        if self.beat is not None:
+            self.beat = None
+            self.start()
+
+    def start(self):
+        if self.beat is None:
+            self.beat = threading.Thread(target=self.run_beat, daemon=True)
+            self.beat.start()
+
+    def run_beat(self):
+        due = {}  # schedule name -> time of the next run
+        while True:
+            now = time.time()
+            for name, entry in list(self.conf.beat_schedule.items()):
+                if now >= due.setdefault(name, now + entry["schedule"]):
+                    due[name] = now + entry["schedule"]
+                    task = self.tasks[entry["task"].rsplit(".", 1)[-1]]
+                    task.apply_async(tuple(entry.get("args", ())))
+            time.sleep(1)
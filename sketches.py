@@ -0,0 +1,76 @@
+"""
+This file defines the HyperLogLog sketches that estimate how many distinct
+species were seen in a box, without reading its sightings:
+
+    registers = bytearray(sketches.REGISTERS)
+    sketches.add(registers, species_id)
+    sketches.estimate(sketches.merge([registers, other]))
+
+A sketch is REGISTERS bytes. Each value is hashed to one register, which
+keeps the highest rank (leading zeros + 1) of the hashes it received. The
+union of boxes is the register-wise maximum of their sketches, so per-cell
+sketches merge into any box of cells, whatever their overlap in species.
+
+Error bounds, with PRECISION = 10 (1024 registers, 1 KB per sketch):
+
+- up to about 2500 species, where linear counting answers, the relative
+  standard error is about 1 / sqrt(2 * 1024), 2.2%: a box of 400 species is
+  off by 9 or fewer about two times in three, and by 18 or fewer about 95%
+  of the time. Counts under 50 are often off by one.
+- above, it is 1.04 / sqrt(1024), about 3.3%, so the estimate is within
+  6.5% about 95% of the time
+
+The hash is fixed, so a set of species always gets the same estimate, and
+adding species already counted changes nothing.
+"""
+
+import base64
+import hashlib
+import math
+
+PRECISION = 10
+REGISTERS = 2**PRECISION
+HASH_BITS = 64
+ALPHA = 0.7213 / (1 + 1.079 / REGISTERS)
+
+
+# Record a value, like a species id, in the registers (a bytearray)
+def add(registers, value):
+    digest = hashlib.blake2b(str(value).encode(), digest_size=HASH_BITS // 8)
+    hashed = int.from_bytes(digest.digest(), "big")
+    index = hashed >> (HASH_BITS - PRECISION)
+    rest = hashed & ((1 << (HASH_BITS - PRECISION)) - 1)
+    rank = HASH_BITS - PRECISION - rest.bit_length() + 1
+    if rank > registers[index]:
+        registers[index] = rank
+
+
+# The sketch of the union of the sets of the sketches
+def merge(sketches):
+    sketches = list(sketches)
+    if not sketches:
+        return bytearray(REGISTERS)
+    if len(sketches) == 1:
+        return bytearray(sketches[0])
+    return bytearray(map(max, *sketches))
+
+
+# Estimated number of distinct values recorded in the registers
+def estimate(registers):
+    zeros = registers.count(0)
+    if zeros == REGISTERS:
+        return 0
+    raw = ALPHA * REGISTERS**2 / sum(2.0**-rank for rank in registers)
+    if raw <= 2.5 * REGISTERS and zeros:
+        # Linear counting, more accurate for small sets
+        return round(REGISTERS * math.log(REGISTERS / zeros))
+    return round(raw)
+
+
+# Registers as text for the database, and back
+def encode(registers):
+    return base64.b64encode(bytes(registers)).decode()
+
+
+def decode(text):
+    return bytearray(base64.b64decode(text))
@@ -0,0 +1,107 @@
+"""
+This file keeps the species names in memory so that the APIs can translate
+between names and species ids without joining the species table. An n-gram
+index over the names answers the species search box without a LIKE scan.
+
+Unknown names and ids are misses. They only reload the names when the data
+generation moved since the last load, so junk requests never reload them.
+"""
+
+import threading
+from .common import db, fork_safe, data_generation
+
+GRAM = 3  # Longest n-gram in the search index
+
+
+# Every substring of text with 1 to GRAM characters
+def grams(text):
+    return {
+        text[start : start + n]
+        for n in range(1, GRAM + 1)
+        for start in range(len(text) - n + 1)
+    }
+
+
+class SpeciesCatalog:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_name = None
+        self.by_id = None
+        self.index = None  # n-gram -> ids of the names containing it
+        self.generation = None  # data generation of the last load
+
+    # (Re)read the species table; other workers may have added species
+    def load(self):
+        # Read first, so that a write during the load makes it stale
+        generation = data_generation.read()[0]
+        rows = db(db.species).select(db.species.id, db.species.name)
+        index = {}
+        for row in rows:
+            for gram in grams(row.name.lower()):
+                index.setdefault(gram, set()).add(row.id)
+        with self.lock:
+            self.by_name = {row.name: row.id for row in rows}
+            self.by_id = {row.id: row.name for row in rows}
+            self.index = index
+            self.generation = generation
+
+    # Load the names the first time, or again after a write or an import
+    def refresh(self):
+        if self.by_name is None or data_generation.read()[0] != self.generation:
+            self.load()
+
+    def name(self, species_id):
+        if self.by_id is None or species_id not in self.by_id:
+            self.refresh()
+        return self.by_id.get(species_id)
+
+    # Id of the species with this name, or None
+    def id(self, name):
+        ids = self.ids([name])
+        return ids[0] if ids else None
+
+    # Ids of the species with these names, ignoring unknown names
+    def ids(self, names):
+        if self.by_name is None or any(name not in self.by_name for name in names):
+            self.refresh()
+        return [self.by_name[name] for name in names if name in self.by_name]
+
+    # All names, sorted
+    def names(self):
+        if self.by_name is None:
+            self.load()
+        return sorted(self.by_name)
+
+    # Ids of the species whose name contains the fragment, ignoring case.
+    # Names starting with it come first, then names with a word starting with it.
+    def search(self, fragment):
+        if self.index is None:
+            self.load()
+        by_id, index = self.by_id, self.index
+        fragment = fragment.lower()
+        if not fragment:
+            return [species_id for _, species_id in sorted(self.by_name.items())]
+        if len(fragment) <= GRAM:
+            ids = index.get(fragment, set())
+        else:
+            # Names holding every trigram of the fragment, checked in full
+            trigrams = [gram for gram in grams(fragment) if len(gram) == GRAM]
+            postings = [index.get(gram, set()) for gram in trigrams]
+            ids = [
+                species_id
+                for species_id in set.intersection(*postings)
+                if fragment in by_id[species_id].lower()
+            ]
+
+        def rank(species_id):
+            name = by_id[species_id].lower()
+            if name.startswith(fragment):
+                return (0, name)
+            if (" " + fragment) in name or ("-" + fragment) in name:
+                return (1, name)
+            return (2, name)
+
+        return sorted(ids, key=rank)
+
+
+catalog = fork_safe(SpeciesCatalog())
@@ -6,7 +6,7 @@ const app = {};
 app.vue = Vue.createApp({
   data() {
     return {
-      speciesList: speciesList || [],
+      speciesList: [],
       birdCounts: {},
       searchQuery: "",
       lat: lat, // Latitude passed from the server
@@ -15,15 +15,25 @@ app.vue = Vue.createApp({
       editId: new URLSearchParams(window.location.search).get('edit_id'),
     };
   },
-  computed: {
-    // Filter species list based on search query
-    filteredSpecies() {
-      return this.speciesList.filter((species) =>
-        species.toLowerCase().includes(this.searchQuery.toLowerCase())
-      );
-    },
-  },
   methods: {
+    // Search once typing pauses, rather than on every keystroke
+    startSearchSpecies() {
+      if (this.searchTimeout !== undefined)
+        clearTimeout(this.searchTimeout);
+
+      this.searchTimeout = setTimeout(this.searchSpecies, 500);
+    },
+
+    // Fetch the species matching the search query
+    searchSpecies() {
+      this.searchTimeout = undefined;
+      const query = this.searchQuery;
+      axios.get(species_search_url, { params: { q: query } }).then((response) => {
+        // Drop answers to a query that has since been edited
+        if (query === this.searchQuery) this.speciesList = response.data.species;
+      });
+    },
+
     // Increment count of birds for a given species
     incrementCount(species) {
       if (!this.birdCounts[species]) this.birdCounts[species] = 0;
@@ -88,6 +98,7 @@ app.vue = Vue.createApp({
     },
   },
   mounted() {
+    this.searchSpecies();
     this.fetchChecklistData();  // Fetch checklist data if editing
   }
 });
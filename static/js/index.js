@@ -148,6 +148,23 @@ app.openPopup = function (latlng) {
     .openOn(app.map);
 };
 
+// List the "z/x/y" tiles covering the current view at the given zoom
+app.visibleTiles = function (zoom) {
+  const pixels = app.map.getPixelBounds();
+  const size = 256;
+  const count = Math.pow(2, zoom);
+  const tiles = [];
+
+  for (let y = Math.floor(pixels.min.y / size); y <= Math.floor(pixels.max.y / size); y++) {
+    if (y < 0 || y >= count) continue;
+    for (let x = Math.floor(pixels.min.x / size); x <= Math.floor(pixels.max.x / size); x++) {
+      // Wrap around the antimeridian
+      tiles.push(zoom + "/" + (((x % count) + count) % count) + "/" + y);
+    }
+  }
+  return [...new Set(tiles)];
+};
+
 // Close the map's popup, if it is open
 app.closePopup = function () {
   if (app.popup) {
@@ -173,23 +190,35 @@ app.data = {
     return {
       filterString: "",
       filterList: [],
-      speciesList: speciesList,
+      speciesList: [],
       sightingsPromise: undefined,
+      richness: false,
     };
   },
-  methods: {
-    includesFilterString: function (species) {
-      return species.toUpperCase().includes(this.filterString.toUpperCase());
+  computed: {
+    hiddenSelection: function () {
+      return this.filterList.filter((species) => !this.speciesList.includes(species));
     },
-
+  },
+  methods: {
     clearFilter: function () {
       if (this.filterString !== "" || this.filterList.length > 0) {
         this.filterString = "";
         this.filterList = [];
+        this.searchSpecies();
         requestAnimationFrame(this.updateFilter);
       }
     },
 
+    // Ask the server which species match the filter string
+    searchSpecies: function () {
+      const query = this.filterString;
+      axios(species_search_url, { params: { q: query } }).then((response) => {
+        // Drop answers to a query that has since been edited
+        if (query === this.filterString) this.speciesList = response.data.species;
+      });
+    },
+
     startUpdateFilter: function () {
       if (this.updateFilterTimeout !== undefined)
         clearTimeout(this.updateFilterTimeout);
@@ -209,38 +238,86 @@ app.data = {
 
       // Generate search params
       const params = new URLSearchParams();
-      const useFilterList = this.filterList.filter(this.includesFilterString);
-      if (useFilterList.length > 0)
+      const filterString = this.filterString.toUpperCase();
+      if (this.filterList.some((species) => species.toUpperCase().includes(filterString)))
         params.append("list", this.filterList.join(","));
       else if (this.filterString !== "")
         params.append("search", this.filterString);
 
+      const zoom = app.map.getZoom();
+      if (this.richness) {
+        this.fetchRichness(params, zoom);
+        return;
+      }
+
+      // Tiles fetched for another filter or zoom can't be reused
+      const tileKey = params.toString() + "@" + zoom;
+      if (app.tileKey !== tileKey) {
+        app.tileKey = tileKey;
+        app.tiles = new Map();
+      }
+
       // The filter may be changed mid request, so include a way to abort
       const requestAborter = new AbortController();
 
-      // Request sightings from the server
+      // Request the visible tiles that haven't been loaded yet
+      const requests = app.visibleTiles(zoom)
+        .filter((tile) => !app.tiles.has(tile))
+        .map((tile) =>
+          axios(tiles_url + "/" + tile, {
+            ...packedRequest,
+            signal: requestAborter.signal,
+            params: params,
+          }).then((response) => {
+            if (app.tileKey === tileKey)
+              app.tiles.set(tile, unpackSightings(response.data));
+          })
+        );
+
+      const thisPromise = Promise.all(requests).then(() => {
+        if (thisPromise !== this.sightingsPromise) return;
+
+        this.showCells([].concat(...app.tiles.values()));
+        this.sightingsPromise = undefined;
+      });
+
+      thisPromise.abort = requestAborter.abort.bind(requestAborter);
+      this.sightingsPromise = thisPromise;
+    },
+
+    // Request the number of species per cell of the whole view, which tiles
+    // can't be summed into
+    fetchRichness: function (params, zoom) {
+      params.append("mode", "richness");
+      params.append("bounds", app.map.getBounds().toBBoxString());
+      params.append("zoom", zoom);
+
+      const requestAborter = new AbortController();
       const thisPromise = axios(sightings_url, {
+        ...packedRequest,
         signal: requestAborter.signal,
         params: params,
       }).then((response) => {
         if (thisPromise !== this.sightingsPromise) return;
 
-        const sightings = response.data.sightings;
-        app.heat.setLatLngs(sightings);
-
-        // Find median to compute a nice heatmap max
-        sightings.sort((a, b) => b[2] - a[2]);
-        if (sightings.length > 0) {
-          const median = sightings[Math.floor(sightings.length / 2)][2];
-          app.heat.setOptions({ max: median });
-        }
-
+        this.showCells(unpackSightings(response.data));
         this.sightingsPromise = undefined;
       });
 
       thisPromise.abort = requestAborter.abort.bind(requestAborter);
       this.sightingsPromise = thisPromise;
     },
+
+    // Draw [lat, lng, value] cells on the heatmap
+    showCells: function (cells) {
+      app.heat.setLatLngs(cells);
+
+      // Find median to compute a nice heatmap max
+      const counts = cells.map((cell) => cell[2]).sort((a, b) => a - b);
+      if (counts.length > 0) {
+        app.heat.setOptions({ max: counts[Math.floor(counts.length / 2)] });
+      }
+    },
   },
 };
 
@@ -260,6 +337,7 @@ app.map = L.map("map", {
 });
 app.map.on("click", app.mapClicked);
 app.map.on("blur", app.closePopup);
+app.map.on("moveend", () => app.vue.fetchSightings());
 
 // Add street map
 L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
@@ -270,6 +348,7 @@ L.tileLayer("https://tile.openstreetmap.org/{z}/{x}/{y}.png", {
 // Add heatmap, populating it with sighting data
 app.heat = L.heatLayer([]).addTo(app.map);
 app.vue.fetchSightings();
+app.vue.searchSpecies();
 
 // Zoom in on user's approximate location
 axios("https://geolocation-db.com/json/").then((res) => {
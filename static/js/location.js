@@ -5,6 +5,7 @@ app.data = {
     return {
       bounds: L.latLngBounds([0, 0], [0, 0]),
       selectedSpecies: null,
+      granularity: "day",
       speciesList: [],
       trendsData: [],
       contributors: [],
@@ -30,10 +31,10 @@ app.data = {
     loadSpeciesList: function () {
       console.log("Making API request for species list.");
       axios
-        .get(`${species_url}?bounds=${this.bounds.toBBoxString()}`)
+        .get(`${species_url}?bounds=${this.bounds.toBBoxString()}`, packedRequest)
         .then((response) => {
-          console.log("Species list response:", response.data);
-          this.speciesList = response.data.data || [];
+          this.speciesList = unpackSpecies(response.data);
+          console.log("Species list response:", this.speciesList);
         })
         .catch((error) => {
           console.error("Error loading species list:", error);
@@ -58,6 +59,7 @@ app.data = {
           params: {
             bounds: this.bounds.toBBoxString(),
             species_name: speciesName,
+            granularity: this.granularity,
           },
         })
         .then((response) => {
@@ -86,6 +88,7 @@ app.components = {
       return {
         rect: null,
         map: null,
+        heat: null,
       };
     },
     watch: {
@@ -114,25 +117,40 @@ app.components = {
         weight: 1,
       }).addTo(this.map);
 
-      addEventListener("load", () => {
-        // Add heatmap and selection area
-        axios(sightings_url).then((response) => {
-          const heat = L.heatLayer([]).addTo(this.map);
-          const sightings = response.data.sightings;
-          heat.setLatLngs(sightings);
-
-          // Find median to compute a nice heatmap max
-          sightings.sort((a, b) => b[2] - a[2]);
-          if (sightings.length > 0) {
-            const median = sightings[Math.floor(sightings.length / 2)][2];
-            heat.setOptions({ max: median });
-          }
-        });
+      // Heatmap of the clusters of checklists in view, refetched as the map moves
+      this.heat = L.heatLayer([]).addTo(this.map);
+      this.map.on("moveend", () => this.loadClusters());
 
+      addEventListener("load", () => {
         // Update Leaflet map size once css is loaded
         this.map.invalidateSize();
+        this.loadClusters();
       });
     },
+    methods: {
+      loadClusters: function () {
+        axios
+          .get(clusters_url, {
+            params: {
+              bounds: this.map.getBounds().toBBoxString(),
+              zoom: this.map.getZoom(),
+            },
+          })
+          .then((response) => {
+            // [lat, lng, checklists, birds] weighted by birds
+            this.heat.setLatLngs(
+              response.data.clusters.map((c) => [c[0], c[1], c[3]])
+            );
+            // The median makes a nice heatmap max
+            if (response.data.median) {
+              this.heat.setOptions({ max: response.data.median });
+            }
+          })
+          .catch((error) => {
+            console.error("Error loading clusters:", error);
+          });
+      },
+    },
   },
   "species-list": {
     props: ["speciesList"],
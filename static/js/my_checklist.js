@@ -7,17 +7,27 @@ app.vue = Vue.createApp({
   data() {
     return {
       checklists: [], // List of user checklists
+      nextAfterId: null, // Cursor for the next page, if there is one
+      loading: false,
     };
   },
   methods: {
-    // Fetch the user's checklists
+    // Fetch the next page of the user's checklists
     fetchChecklists() {
-      axios.get(get_checklist_url)
+      const params = { limit: 20 };
+      if (this.nextAfterId !== null) params.after_id = this.nextAfterId;
+
+      this.loading = true;
+      axios.get(get_checklist_url, { params: params })
         .then(response => {
-          this.checklists = response.data.checklists;
+          this.checklists.push(...response.data.checklists);
+          this.nextAfterId = response.data.next_after_id;
         })
         .catch((error) => {
           console.error("Error fetching checklists:", error);
+        })
+        .finally(() => {
+          this.loading = false;
         });
     },
 
@@ -31,7 +41,8 @@ app.vue = Vue.createApp({
         if (confirm("Are you sure you want to delete this checklist?")) {
           axios.delete(delete_url + `/${checklistId}`)
             .then(() => {
-              this.fetchChecklists();  // Refresh the list of checklists after deletion
+              // Drop the deleted checklist from the loaded pages
+              this.checklists = this.checklists.filter((c) => c.id !== checklistId);
         })
         .catch(error => {
           console.error("Error deleting checklist:", error);
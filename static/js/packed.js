@@ -0,0 +1,33 @@
+"use strict";
+
+// Decoders for the packed responses of api/sightings and
+// api/species_by_region, see wire.py. Typed arrays use the platform byte
+// order, which is little-endian on every browser platform.
+
+// Axios options asking for the packed form
+const packedRequest = {
+  headers: { Accept: "application/octet-stream" },
+  responseType: "arraybuffer",
+};
+
+// Decode sightings into [lat, lng, count] arrays, as leaflet-heat expects
+function unpackSightings(buffer) {
+  const n = buffer.byteLength / 12;
+  const lats = new Float32Array(buffer, 0, n);
+  const lngs = new Float32Array(buffer, 4 * n, n);
+  const counts = new Uint32Array(buffer, 8 * n, n);
+  const sightings = new Array(n);
+  for (let i = 0; i < n; i++) {
+    sightings[i] = [lats[i], lngs[i], counts[i]];
+  }
+  return sightings;
+}
+
+// Decode species into {common_name, total_count} objects, sorted by name
+function unpackSpecies(buffer) {
+  const n = new Uint32Array(buffer, 0, 1)[0];
+  const totals = new Uint32Array(buffer, 4, n);
+  const text = new TextDecoder().decode(buffer.slice(4 * (n + 1)));
+  const names = n ? text.split("\n") : [];
+  return names.map((name, i) => ({ common_name: name, total_count: totals[i] }));
+}
@@ -0,0 +1,54 @@
+"""
+This file defines JSON responses that are written as they are produced, for
+results too large to serialize in one piece:
+
+    return streaming.json_object("sightings", rows, count=n)
+
+The body is {"count": n, "sightings": [...]}, sent in chunks of CHUNK_ROWS
+rows, so the first bytes leave before the last rows are read and no request
+holds the whole JSON text. Rows read from the database come from
+query_rows, which holds a connection of its own for as long as the body is
+written.
+"""
+
+import json
+from py4web import response
+from py4web.core import objectify
+
+CHUNK_ROWS = 1000
+
+
+# A body streaming an object with the scalar fields, then the rows under key
+def json_object(key, rows, **fields):
+    response.headers["Content-Type"] = "application/json"
+    head = json.dumps(dict(fields, **{key: []}), default=objectify)
+    # Everything before the closing "]}" of the empty list
+    return chunks(head[: head.rindex("]")], rows, head[head.rindex("]") :])
+
+
+def chunks(head, rows, tail):
+    yield head
+    batch = []
+    separator = ""
+    for row in rows:
+        batch.append(row)
+        if len(batch) == CHUNK_ROWS:
+            yield separator + json.dumps(batch, default=objectify)[1:-1]
+            separator = ","
+            batch = []
+    if batch:
+        yield separator + json.dumps(batch, default=objectify)[1:-1]
+    yield tail
+
+
+# The rows of select(), a generator of rows of a DAL query, on a connection
+# taken when the body is written: the db fixture has released the request's
+# by then. A stream closed early, by a client going away, rolls back.
+def query_rows(db, select):
+    db.on_request({})
+    try:
+        yield from select()
+    except BaseException:
+        db.on_error({})
+        raise
+    db.on_success({})
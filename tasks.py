@@ -1,34 +1,168 @@
 """
-To use celery tasks:
-1) pip install -U "celery[redis]" 
-2) In settings.py: 
+Background jobs. With USE_CELERY = False (the default) they run on a thread
+pool inside the web process, see scheduling.py. To run them on Celery instead:
+1) pip install -U "celery[redis]"
+2) In settings.py:
    USE_CELERY = True
    CELERY_BROKER = "redis://localhost:6379/0"
 3) Start "redis-server"
 4) Start "celery -A apps.{appname}.tasks beat"
 5) Start "celery -A apps.{appname}.tasks worker --loglevel=info" for each worker
 
+Jobs that fill this process' caches always run on the local pool, since a
+Celery worker can't reach them.
 """
-from .common import settings, scheduler, db, Field
+import functools
+import os
+from .common import (
+    settings,
+    scheduler,
+    local_scheduler,
+    db,
+    result_cache,
+    tile_cache,
+    column_store,
+    startup,
+)
+from .species import catalog
+from . import grid, heatmap, rollups
 
-# example of task that needs db access
+try:
+    import fcntl
+except ImportError:  # Windows runs a single worker process
+    fcntl = None
+
+
+# Gives the task its own connection, committed on success
+def uses_db(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # this task will be executed in its own thread, connect to db
+        db.on_request({})
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            # rollback on failure
+            db.on_error({})
+            raise
+        db.on_success({})
+        return result
+
+    return wrapper
+
+
+# Recompute the species_day rollup from scratch
+@scheduler.task
+@uses_db
+def rebuild_rollup():
+    rollups.rebuild()
+
+
+# Recompute the per-cell checklist counts behind api/top_contributors
 @scheduler.task
-def my_task():
+@uses_db
+def rebuild_contributors():
+    rollups.rebuild_contributors()
+
+
+# Recompute the checklist clusters of every zoom behind api/sightings/clusters
+@scheduler.task
+@uses_db
+def rebuild_clusters():
+    rollups.rebuild_clusters()
+
+
+# Fill the rollups of databases created before they existed, in the
+# background once the process serves requests. Workers starting together
+# take turns, and only the first finds them empty. Results cached meanwhile
+# came from the empty rollups, so they are dropped.
+@local_scheduler.task
+@uses_db
+def backfill_rollups():
+    with open(os.path.join(settings.DB_FOLDER, "backfill.lock"), "a") as lock:
+        if fcntl:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        if rollups.backfill():
+            result_cache.bump()
+
+
+# Compute the unfiltered tiles of the lowest zooms, which cover the most
+# checklists, so that no request waits for them. Cached tiles are kept.
+@local_scheduler.task
+@uses_db
+def warm_tiles(zooms=settings.WARM_TILE_ZOOMS):
+    for z in range(min(zooms, grid.MAX_ZOOM + 1)):
+        for x in range(2**z):
+            for y in range(2**z):
+                heatmap.tile(z, x, y)
+
+
+# Read the checklists and sightings into the column store, see columns.py.
+# Until it is done, the store only answers if no write came in meanwhile.
+@local_scheduler.task
+@uses_db
+def load_columns():
+    column_store.load()
+
+
+last_import = None  # rows recorded in import_progress at the last check
+
+
+# Refresh the caches when the CSV importer has loaded rows since the last check
+@local_scheduler.task
+@uses_db
+def check_imports():
+    global last_import
     try:
-        # this task will be executed in its own thread, connect to db
-        db._adapter.reconnect()
-        # do something here
-        db.commit()
-    except:
-        # rollback on failure
+        imported = db.executesql(
+            "SELECT COUNT(*), SUM(rows_done) FROM import_progress;"
+        )[0]
+    except Exception:
+        # The importer has never run
         db.rollback()
+        return
+    if last_import is not None and imported != last_import:
+        catalog.load()
+        result_cache.bump()
+        tile_cache.clear()
+        if column_store:
+            load_columns.delay()
+        if settings.WARM_TILES:
+            warm_tiles.delay()
+    last_import = imported
+
+
+local_scheduler.conf.beat_schedule.update(
+    {
+        "check_imports": {
+            "task": "apps.%s.tasks.check_imports" % settings.APP_NAME,
+            "schedule": float(settings.IMPORT_CHECK_SECONDS),
+            "args": (),
+        },
+    }
+)
+
+
+# Load the species names and the column store before the workers fork, so
+# that they share one copy, see common.Startup
+@startup.preload
+@uses_db
+def preload():
+    catalog.load()
+    if column_store:
+        column_store.load()
 
 
-# run my_task very 10 seconds
-scheduler.conf.beat_schedule = {
-    "my_first_task": {
-        "task": "apps.%s.tasks.my_task" % settings.APP_NAME,
-        "schedule": 10.0,
-        "args": (),
-    },
-}
+# Start the jobs of this process. Run before its first request, see
+# common.Startup, or called by a script that needs them.
+@startup.register
+def start():
+    local_scheduler.start()
+    backfill_rollups.delay()
+    if column_store:
+        # Also when writes of other worker processes made the columns stale
+        column_store.on_stale = load_columns.delay
+        if not column_store.ready:
+            load_columns.delay()
+    if settings.WARM_TILES:
+        warm_tiles.delay()
@@ -0,0 +1,68 @@
+"""
+Fixtures of the tests: a copy of the app, made of symlinks, with its own
+databases folder in a temporary directory, imported like py4web does and
+loaded with the sample data by sample_data/dbpopulator.py. Its rollups are
+left empty; tests that need them call rollups.backfill(). The modules of
+the app are attributes of the app fixture, like app.rollups.
+
+Run from the app folder with "python -m pytest tests".
+"""
+
+import importlib.util
+import os
+
+import pytest
+
+APP_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_NAME = "package"
+
+# Settings of the copy, appended to its settings.py through settings_private.py
+SETTINGS = """
+USE_COLUMN_STORE = True
+"""
+
+
+def load_dbpopulator():
+    spec = importlib.util.spec_from_file_location(
+        "dbpopulator", os.path.join(APP_FOLDER, "sample_data", "dbpopulator.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture(scope="session")
+def app(tmp_path_factory):
+    apps = tmp_path_factory.mktemp("tests") / "apps"
+    folder = apps / APP_NAME
+    (folder / "databases").mkdir(parents=True)
+    (apps / "__init__.py").touch()
+    for name in os.listdir(APP_FOLDER):
+        if name not in ("databases", "tests", "__pycache__", "settings_private.py"):
+            os.symlink(os.path.join(APP_FOLDER, name), folder / name)
+    (folder / "settings_private.py").write_text(SETTINGS)
+
+    dbpopulator = load_dbpopulator()
+    app = dbpopulator.load_app(str(folder))
+    importer = dbpopulator.Importer(app.db, 10000)
+    samples = os.path.join(APP_FOLDER, "sample_data")
+    importer.import_file(
+        os.path.join(samples, "species.csv"),
+        "species",
+        dbpopulator.species_columns,
+        " ON CONFLICT DO NOTHING",
+    )
+    importer.import_file(
+        os.path.join(samples, "checklists.csv"),
+        "checklist",
+        dbpopulator.checklist_columns,
+    )
+    species_ids = importer.species_ids()
+    importer.import_file(
+        os.path.join(samples, "sightings.csv"),
+        "sighting",
+        lambda header: dbpopulator.sighting_columns(header, species_ids),
+    )
+    yield app
+    app.db.close()
+
@@ -0,0 +1,149 @@
+import datetime
+import random
+
+import pytest
+
+CASES = 40  # random queries per function
+DAYS = [datetime.date(2021, 2, 1) + datetime.timedelta(days=d) for d in range(10)]
+
+
+@pytest.fixture(scope="module")
+def store(app):
+    app.rollups.backfill()
+    app.db.commit()
+    store = app.common.column_store
+    store.load()
+    return store
+
+
+# A periods.Period within the sample data, or None
+def random_period(app, rng):
+    if rng.random() < 0.3:
+        return None
+    start = rng.choice(DAYS + [None])
+    stop = rng.choice([day for day in DAYS if not start or day > start] + [None])
+    months = rng.choice([None, (2,), (1, 3), (2, 6)])
+    if start is None and stop is None and months is None:
+        return None
+    return app.periods.Period(start, stop, months)
+
+
+# Box around a random checklist, from a few streets to half the continent
+def random_bounds(rng, points):
+    lat, lng = rng.choice(points)
+    width = rng.choice([0.02, 0.1, 0.5, 2, 30])
+    height = width * rng.uniform(0.5, 1)
+    lng += rng.uniform(-width, width) / 2
+    lat += rng.uniform(-height, height) / 2
+    return [lng - width, lat - height, lng + width, lat + height]
+
+
+# (function, arguments) of random queries of every @columnar function; the
+# cells of a box as api/sightings snaps them, and those of a tile
+def queries(app, rng):
+    db, grid = app.db, app.grid
+    points = db.executesql("SELECT latitude, longitude FROM checklist;")
+    species = [row[0] for row in db.executesql("SELECT DISTINCT species_id FROM sighting;")]
+    for _ in range(CASES):
+        species_ids = rng.choice([None, tuple(rng.sample(species, rng.randint(1, 3)))])
+        bounds = random_bounds(rng, points)
+        period = random_period(app, rng)
+        zoom = rng.randint(3, 14)
+        size = grid.cell_size(zoom)
+        lat, lng = rng.choice(points)
+        x, y = grid.tile_index(lat, lng, zoom)
+
+        yield app.controllers.all_sightings, (species_ids, period)
+        yield app.heatmap.grid_cells, (
+            species_ids,
+            grid.snap_bounds(bounds, size),
+            size,
+            period,
+        )
+        yield app.heatmap.grid_cells, (
+            species_ids,
+            grid.tile_bounds(zoom, x, y),
+            size,
+            period,
+        )
+        yield app.controllers.species_totals, (bounds, period)
+        yield app.rollups.species_trend, (
+            rng.choice(species),
+            bounds,
+            rng.choice(list(app.rollups.GRANULARITIES)),
+            period,
+        )
+        yield app.rollups.top_contributors, (bounds, period)
+
+
+# Every query is answered alike by the columns and the DAL
+def check(app, store, seed):
+    assert store.current()
+    for func, args in queries(app, random.Random(seed)):
+        expected = func.__wrapped__(*args)
+        result = getattr(store, func.__name__)(*args)
+        assert app.columns.same(result, expected), (func.__name__, args)
+
+
+def test_columns_match_dal(app, store):
+    check(app, store, 1)
+
+
+def test_columns_match_dal_after_writes(app, store):
+    db, controllers = app.db, app.controllers
+    rng = random.Random(2)
+    names = [row[0] for row in db.executesql("SELECT name FROM species LIMIT 50;")]
+    points = db.executesql("SELECT latitude, longitude FROM checklist;")
+
+    def checklist(**data):
+        lat, lng = rng.choice(points)
+        data.update(
+            lat=lat + rng.uniform(-0.05, 0.05),
+            lng=lng + rng.uniform(-0.05, 0.05),
+            date="2021-02-0%dT08:30:00" % rng.randint(1, 9),
+            species=[
+                dict(name=name, count=rng.randint(1, 20))
+                for name in rng.sample(names, rng.randint(1, 5))
+            ],
+        )
+        return data
+
+    # New checklists, then one of them edited, like api/checklist/submit
+    changes = []
+    ids = controllers.save_checklists("test", [checklist() for _ in range(20)], changes)
+    db.commit()
+    controllers.after_write(changes)
+    changes = []
+    controllers.save_checklists("test", [checklist(editId=ids[0])], changes)
+    db.commit()
+    controllers.after_write(changes)
+
+    # A sample checklist deleted, like my_checklist/delete
+    deleted = db(db.checklist.observer_id != "test").select().first()
+    sightings = db(db.sighting.event_id == deleted.event_id)
+    change = (deleted, sightings.select(), -1)
+    db(db.checklist.id == deleted.id).delete()
+    app.rollups.update(*change)
+    sightings.delete()
+    db.commit()
+    controllers.after_write([change])
+
+    check(app, store, 3)
+
+
+# A date with an offset is stored in UTC, and reaches the columns too
+def test_submitted_date_with_offset(app, store):
+    db, controllers = app.db, app.controllers
+    name = db.executesql("SELECT name FROM species LIMIT 1;")[0][0]
+    data = dict(
+        lat=37.2,
+        lng=-122.1,
+        date="2021-02-05T10:00:00+02:00",
+        species=[dict(name=name, count=3)],
+    )
+    changes = []
+    [checklist_id] = controllers.save_checklists("offset", [data], changes)
+    db.commit()
+    controllers.after_write(changes)
+    assert db.checklist[checklist_id].date == datetime.datetime(2021, 2, 5, 8, 0)
+    check(app, store, 5)
@@ -0,0 +1,102 @@
+import random
+import threading
+import time
+
+ROLLUPS = {
+    "species_day": ["species_id", "day", "lat_cell", "lng_cell", "total"],
+    "species_week": ["species_id", "week", "lat_cell", "lng_cell", "total"],
+    "species_sketch": ["lat_cell", "lng_cell", "registers"],
+    "observer_cell": ["observer_id", "lat_cell", "lng_cell", "checklists"],
+    "cluster_cell": [
+        "zoom",
+        "lat_cell",
+        "lng_cell",
+        "checklists",
+        "birds",
+        "lat_sum",
+        "lng_sum",
+    ],
+}
+
+
+# Sorted rows of every rollup, without their ids, with floats rounded to
+# digits if given, as sums added in another order differ in the last ones
+def contents(db, digits=None):
+    def value(v):
+        return round(v, digits) if digits is not None and isinstance(v, float) else v
+
+    return {
+        table: sorted(
+            (
+                tuple(value(v) for v in row)
+                for row in db.executesql(
+                    "SELECT %s FROM %s;" % (", ".join(columns), table)
+                )
+            ),
+            key=repr,
+        )
+        for table, columns in ROLLUPS.items()
+    }
+
+
+def test_backfill_fills_empty_rollups(app):
+    db = app.db
+    for table in ROLLUPS:
+        db.executesql("DELETE FROM %s;" % table)
+    db.commit()
+
+    assert app.rollups.backfill()
+    db.commit()
+    filled = contents(db)
+    assert all(filled.values())
+
+    birds, checklists = db.executesql(
+        "SELECT SUM(sighting.count), COUNT(DISTINCT checklist.id) "
+        "FROM sighting JOIN checklist ON sighting.event_id = checklist.event_id;"
+    )[0]
+    assert sum(row[-1] for row in filled["species_day"]) == birds
+    assert sum(row[-1] for row in filled["species_week"]) == birds
+    assert sum(row[-1] for row in filled["observer_cell"]) == db(db.checklist).count()
+    top_zoom = [row for row in filled["cluster_cell"] if row[0] == 0]
+    assert sum(row[3] for row in top_zoom) == db(db.checklist).count()
+    assert checklists
+
+    # Nothing is left to fill, and the rebuilds agree with the backfill
+    assert not app.rollups.backfill()
+    app.rollups.rebuild_all()
+    db.commit()
+    assert contents(db) == filled
+
+
+# Checklists submitted from another connection while the backfill runs in the
+# background, as on the first start of a database without rollups
+def test_writes_during_backfill(app):
+    db = app.db
+    for table in ROLLUPS:
+        db.executesql("DELETE FROM %s;" % table)
+    db.commit()
+    names = [row[0] for row in db.executesql("SELECT name FROM species LIMIT 20;")]
+    backfill = threading.Thread(target=app.tasks.backfill_rollups)
+    backfill.start()
+
+    written, rng = 0, random.Random(4)
+    while backfill.is_alive() or not written:
+        data = dict(
+            lat=rng.uniform(36.5, 37.8),
+            lng=rng.uniform(-122.5, -121.5),
+            date="2021-02-0%dT07:00:00" % rng.randint(1, 9),
+            species=[dict(name=name, count=rng.randint(1, 9)) for name in names[:3]],
+        )
+        changes = []
+        app.controllers.save_checklists("backfill", [data], changes)
+        db.commit()
+        app.controllers.after_write(changes)
+        written += 1
+        time.sleep(0.05)
+    backfill.join()
+
+    # The rollups account for every checklist, written before or after
+    filled = contents(db, digits=6)
+    app.rollups.rebuild_all()
+    db.commit()
+    assert contents(db, digits=6) == filled
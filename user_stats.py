@@ -0,0 +1,53 @@
+"""
+This file computes the per-user aggregates shown on the statistics page.
+It only needs a DAL with the checklist, sighting and species tables, so it can also be
+used outside of a request (see benchmarks/bench_statistics.py).
+"""
+
+
+# Aggregate all of a user's checklists with two queries, in a single pass each
+def user_statistics(db, observer_id, search=""):
+    sightingsByDay = {}
+    timeByDay = {}
+    timeByMonth = {}
+    places = {}  # checklist id -> (date, (latitude, longitude))
+    events = db(db.checklist.observer_id == observer_id).iterselect(
+        db.checklist.id,
+        db.checklist.date,
+        db.checklist.latitude,
+        db.checklist.longitude,
+        db.checklist.duration_minutes,
+        orderby=db.checklist.date,
+    )
+    for event in events:
+        date = event.date.date()
+        minutes = event.duration_minutes or 0
+        sightingsByDay[date] = sightingsByDay.get(date, 0) + 1
+        timeByDay[date] = timeByDay.get(date, 0) + minutes
+        timeByMonth[date.month] = timeByMonth.get(date.month, 0) + minutes
+        places[event.id] = (date, (event.latitude, event.longitude))
+
+    # Species Seen, When, Where
+    # Only names and ids come back, so the rows are used unparsed
+    query = (
+        (db.checklist.observer_id == observer_id)
+        & (db.sighting.event_id == db.checklist.event_id)
+        & (db.sighting.species_id == db.species.id)
+    )
+    if search:
+        query &= db.species.name.contains(search)
+    speciesSeen = {}
+    rows = db.executesql(
+        db(query)._select(db.species.name, db.checklist.id, orderby=db.checklist.date)
+    )
+    for name, checklist_id in rows:
+        # Skip checklists submitted since the first query
+        if checklist_id in places:
+            speciesSeen.setdefault(name, []).append(places[checklist_id])
+
+    return dict(
+        sightingsByDay=sightingsByDay,
+        timeByDay=timeByDay,
+        timeByMonth=timeByMonth,
+        speciesSeen=speciesSeen,
+    )
@@ -0,0 +1,56 @@
+"""
+This file defines the packed binary form of the sighting payloads, served
+instead of JSON to clients that send "Accept: application/octet-stream".
+Values are little-endian and stored column by column, which keeps similar
+bytes together for gzip or brotli on the front server:
+
+- sightings: Float32 latitudes[n], Float32 longitudes[n], Uint32 counts[n],
+  with n = length / 12
+- species: Uint32 n, Uint32 totals[n], then the n names in UTF-8, separated
+  by newlines
+
+Both forms get their own ETag from the conditional GET fixture of the actions.
+"""
+
+import sys
+from array import array
+from py4web import request, response
+
+MEDIA_TYPE = "application/octet-stream"
+
+
+# Whether the client asked for the packed form. Responses vary with the
+# Accept header either way.
+def wants_packed():
+    response.headers["Vary"] = "Accept"
+    return MEDIA_TYPE in request.headers.get("Accept", "")
+
+
+# The little-endian bytes of an array
+def little_endian(values):
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tobytes()
+
+
+# Pack a list of [lat, lng, count]
+def pack_sightings(sightings):
+    columns = (
+        array("f", [row[0] for row in sightings]),
+        array("f", [row[1] for row in sightings]),
+        array("I", [row[2] or 0 for row in sightings]),
+    )
+    return b"".join(little_endian(column) for column in columns)
+
+
+# Pack a list of (name, total)
+def pack_species(species):
+    totals = array("I", [len(species)] + [total or 0 for _, total in species])
+    names = "\n".join(name for name, _ in species).encode("utf8")
+    return little_endian(totals) + names
+
+
+# Mark a packed body as such; its ETag comes from conditional.ConditionalGet
+def reply(body):
+    response.headers["Content-Type"] = MEDIA_TYPE
+    return body